@@ -1,19 +1,46 @@
+import logging
 import serial
 import struct
 import time
 
+import device_profiles
+import modbus_rtu
+import modbus_log
+from modbus_log import HexFrame
+from modbus_rtu import calculate_crc  # CRC校验函数，采用Modbus CRC-16标准（查表法）
 
-# CRC校验函数，采用Modbus CRC-16标准
-def calculate_crc(data: bytearray) -> bytearray:
-    crc_value = 0xFFFF
-    for byte in data:
-        crc_value ^= byte
-        for _ in range(8):
-            if crc_value & 0x0001:
-                crc_value = (crc_value >> 1) ^ 0xA001
-            else:
-                crc_value >>= 1
-    return struct.pack('<H', crc_value)
+logger = logging.getLogger(__name__)
+
+PROFILE = device_profiles.DS5L2
+
+# 多段位置参数：第1段从P4-10(0x040A)开始，每段占7个寄存器
+# 段内偏移：0 位置低位，1 位置高位，2 速度，3 加速时间，4 减速时间，5 P4-15(未使用)，6 调整时间
+SEGMENT_BASE = PROFILE['position'].address
+SEGMENT_STRIDE = PROFILE['position'].stride
+MAX_SEGMENTS = PROFILE['position'].count
+# 段定义中的键 -> 寄存器描述
+SEGMENT_FIELDS = {
+    'pulse_count': PROFILE['position'],
+    'speed': PROFILE['speed'],
+    'acc_time': PROFILE['acc_time'],
+    'dec_time': PROFILE['dec_time'],
+    'aux': PROFILE['aux'],
+    'adjust_time': PROFILE['adjust_time'],
+}
+
+# send_command的指令类型 -> (寄存器描述, 参数名, 默认值)
+COMMAND_FIELDS = {
+    "enable": (PROFILE['enable'], 'enable', False),
+    "position": (PROFILE['position'], 'pulse_count', 0),
+    "speed": (PROFILE['speed'], 'speed', 0),
+    "acc_time": (PROFILE['acc_time'], 'time_ms', 0),
+    "dec_time": (PROFILE['dec_time'], 'time_ms', 0),
+    "adjust_time": (PROFILE['adjust_time'], 'time_ms', 0),
+    "valid_segments": (PROFILE['valid_segments'], 'count', 0),
+    "start_segment": (PROFILE['start_segment'], 'number', 0),
+    "set_segment": (PROFILE['set_segment'], 'number', 0),
+    "clear_alarm": (PROFILE['clear_alarm'], 'clear', True),
+}
 
 
 # 生成Modbus RTU命令
@@ -47,11 +74,12 @@ def configure_serial(port, baudrate=9600, timeout=1):
 
 
 # 发送RTU命令并接收响应
-def send_rtu_command(ser, command):
-    ser.write(command)  # 发送命令
-    time.sleep(0.1)  # 等待响应时间
-    response = ser.read(ser.in_waiting)  # 读取所有返回数据
-    return response
+def send_rtu_command(ser, command, stop=False):
+    # 发送命令，按帧边界接收完整应答（不再固定延时）
+    # stop为True时作为停止/安全指令发送，经总线调度器时以最高优先级执行
+    if stop:
+        return modbus_rtu.transact_stop(ser, command)
+    return modbus_rtu.transact(ser, command)
 
 
 # 格式化输出RTU命令
@@ -61,7 +89,10 @@ def format_rtu_command(command: bytearray):
 # 拆解反馈数据
 def parse_response(response: bytearray):
     if len(response) < 5:  # 确保响应至少包含地址、功能码、数据和CRC
-        print("无效的响应数据。")
+        logger.warning("无效的响应数据: %s", HexFrame(response))
+        return
+    if not logger.isEnabledFor(logging.DEBUG):
+        # 解析结果只用于调试输出
         return
 
     # 提取通讯地址和功能码
@@ -74,11 +105,8 @@ def parse_response(response: bytearray):
         data = struct.unpack('>H', response[3:5])[0]
 
         # 打印解析出的信息
-        print(f"响应解析 (功能码 03 - 读取寄存器):")
-        print(f"通讯地址: {address:#04X}")
-        print(f"功能码: {function:#04X}")
-        print(f"字节数: {byte_count}")
-        print(f"寄存器数据: {data:#06X}")
+        logger.debug("响应解析 (功能码 03 - 读取寄存器): 通讯地址 %#04X，功能码 %#04X，字节数 %d，寄存器数据 %#06X",
+                     address, function, byte_count, data)
 
     elif function == 0x06:  # 写入寄存器
         # 写入寄存器响应: 6个字节
@@ -86,39 +114,39 @@ def parse_response(response: bytearray):
         data = struct.unpack('>H', response[4:6])[0]
 
         # 打印解析出的信息
-        print(f"响应解析 (功能码 06 - 写入寄存器):")
-        print(f"通讯地址: {address:#04X}")
-        print(f"功能码: {function:#04X}")
-        print(f"寄存器地址: {register_address:#06X}")
-        print(f"数据内容: {data:#06X}")
+        logger.debug("响应解析 (功能码 06 - 写入寄存器): 通讯地址 %#04X，功能码 %#04X，寄存器地址 %#06X，数据内容 %#06X",
+                     address, function, register_address, data)
+
+    elif function == 0x10:  # 写入多个寄存器
+        # 写多个寄存器响应: 8个字节
+        register_address, count = struct.unpack('>HH', response[2:6])
+
+        logger.debug("响应解析 (功能码 10 - 写入多个寄存器): 通讯地址 %#04X，功能码 %#04X，起始地址 %#06X，寄存器数量 %d",
+                     address, function, register_address, count)
         
-def set_motor_enable(ser, enable: bool):
+def set_motor_enable(ser, enable: bool, address=0x01):
     """
     设置电机使能状态
     :param ser: 串口对象
     :param enable: True为使能，False为关闭使能
+    :param address: 通讯地址（从机地址）
     :return: None
     """
-    address = 0x01  # 通讯地址
-    function = 0x06  # 功能码
-    register_address = 0x2105  # 寄存器地址（使能控制）
-    data = 0x0001 if enable else 0x0000  # 1为使能，0为关闭使能
-
-    # 生成命令
-    command = generate_rtu_command(address, function, register_address, data)
+    # 生成命令（F1-05，1为使能，0为关闭使能）
+    command = PROFILE['enable'].raw_command(address, enable)
     
-    # 发送命令并获取响应
-    response = send_rtu_command(ser, command)
+    # 发送命令并获取响应（关闭使能属于停止指令）
+    response = send_rtu_command(ser, command, stop=not enable)
     
     # 打印命令内容
-    print(f"发送的命令: {format_rtu_command(command)}")
+    logger.debug("发送的命令: %s", HexFrame(command))
     
     # 解析响应
     if response:
         parse_response(response)
-        print(f"电机{'使能' if enable else '关闭使能'}{'成功' if len(response) >= 8 else '失败'}")
+        logger.info("电机%s%s", '使能' if enable else '关闭使能', '成功' if len(response) >= 8 else '失败')
     else:
-        print("未收到响应")
+        logger.error("电机%s未收到响应", '使能' if enable else '关闭使能')
 
 def send_command(ser, command_type: str = "custom", **kwargs):
     """
@@ -162,225 +190,270 @@ def send_command(ser, command_type: str = "custom", **kwargs):
             - number: int (段号，范围：0~35)
         对于 "clear_alarm":
             - clear: bool (True为清除报警)
+        所有类型通用:
+            - address: int (通讯地址，默认0x01)
         对于 "custom":
-            - address: int (通讯地址)
             - function: int (功能码)
             - register_address: int (寄存器地址)
             - data: int (数据内容)
     :return: None
     """
-    if command_type == "enable":
-        # 使能控制功能
-        enable = kwargs.get('enable', False)
-        set_motor_enable(ser, enable)
-    
-    elif command_type == "position":
-        # 位置控制模式
-        pulse_count = kwargs.get('pulse_count', 0)
-        segment = kwargs.get('segment', 1)
-        
-        # 确保脉冲数在有效范围内
-        pulse_count = min(max(int(pulse_count), -327689999), 327689999)
-        
-        # 计算寄存器地址
-        offset = (segment - 1) * 7  # 每段偏移7个地址
-        low_register = 0x040A + offset  # 低位寄存器地址
-        high_register = 0x040B + offset  # 高位寄存器地址
-        
-        # 将脉冲数拆分为高低位
-        # 低位范围：-9999~9999
-        # 高位范围：-32768~32768
-        low_value = pulse_count % 10000  # 取低4位，保留符号
-        high_value = pulse_count // 10000  # 取高位
-        
-        # 对于负数，需要使用补码表示
-        if low_value < 0:
-            low_value = 65536 + low_value  # 转换为16位补码
-        if high_value < 0:
-            high_value = 65536 + high_value  # 转换为16位补码
-        
-        print(f"设置第{segment}段脉冲数：{pulse_count}")
-        print(f"低位值：{low_value}，高位值：{high_value}")
-        
-        # 写入低位
-        send_command(ser, command_type="custom",
-                    address=0x01,
-                    function=0x06,
-                    register_address=low_register,
-                    data=low_value)
-        
-        time.sleep(0.1)  # 短暂延时，确保两次写入有间隔
-        
-        # 写入高位
-        send_command(ser, command_type="custom",
-                    address=0x01,
-                    function=0x06,
-                    register_address=high_register,
-                    data=high_value)
-    
-    elif command_type == "speed":
-        # 速度控制
-        speed = kwargs.get('speed', 0)  # 单位：0.1rpm
-        segment = kwargs.get('segment', 1)
-        
-        # 计算寄存器地址
-        offset = (segment - 1) * 7
-        register = 0x040C + offset  # P4-12寄存器地址
-        
-        # 确保速度在有效范围内
-        speed_value = min(max(int(speed), 0), 65535)
-        
-        print(f"设置第{segment}段速度：{speed_value * 0.1}rpm")
-        
-        send_command(ser, command_type="custom",
-                    address=0x01,
-                    function=0x06,
-                    register_address=register,
-                    data=speed_value)
-    
-    elif command_type == "acc_time":
-        # 加速时间控制
-        time_ms = kwargs.get('time_ms', 0)
-        segment = kwargs.get('segment', 1)
-        
-        # 计算寄存器地址
-        offset = (segment - 1) * 7
-        register = 0x040D + offset  # P4-13寄存器地址
-        
-        # 确保时间在有效范围内
-        time_value = min(max(int(time_ms), 0), 65535)
-        
-        print(f"设置第{segment}段加速时间：{time_value}ms")
-        
-        send_command(ser, command_type="custom",
-                    address=0x01,
-                    function=0x06,
-                    register_address=register,
-                    data=time_value)
-    
-    elif command_type == "dec_time":
-        # 减速时间控制
-        time_ms = kwargs.get('time_ms', 0)
-        segment = kwargs.get('segment', 1)
-        
-        # 计算寄存器地址
-        offset = (segment - 1) * 7
-        register = 0x040E + offset  # P4-14寄存器地址
-        
-        # 确保时间在有效范围内
-        time_value = min(max(int(time_ms), 0), 65535)
-        
-        print(f"设置第{segment}段减速时间：{time_value}ms")
-        
-        send_command(ser, command_type="custom",
-                    address=0x01,
-                    function=0x06,
-                    register_address=register,
-                    data=time_value)
-    
-    elif command_type == "adjust_time":
-        # 调整时间控制
-        time_ms = kwargs.get('time_ms', 0)
+    # 通讯地址（从机地址），所有指令类型均可通过address参数指定
+    address = kwargs.get('address', 0x01)
+
+    field = COMMAND_FIELDS.get(command_type)
+    if field is not None:
+        # 按设备描述编码，寄存器地址、范围和帧格式均已预先编译
+        spec, arg, default = field
         segment = kwargs.get('segment', 1)
-        
-        # 计算寄存器地址
-        offset = (segment - 1) * 7
-        register = 0x0410 + offset  # P4-16寄存器地址
-        
-        # 确保时间在有效范围内
-        time_value = min(max(int(time_ms), 0), 65535)
-        
-        print(f"设置第{segment}段调整时间：{time_value}ms")
-        
-        send_command(ser, command_type="custom",
-                    address=0x01,
-                    function=0x06,
-                    register_address=register,
-                    data=time_value)
-    
-    elif command_type == "valid_segments":
-        # 设置有效段数
-        count = kwargs.get('count', 0)
-        
-        # 确保段数在有效范围内
-        count_value = min(max(int(count), 0), 35)
-        
-        print(f"设置有效段数：{count_value}")
-        
-        send_command(ser, command_type="custom",
-                    address=0x01,
-                    function=0x06,
-                    register_address=0x0404,  # P4-04地址
-                    data=count_value)
-    
-    elif command_type == "start_segment":
-        # 设置起始段号
-        number = kwargs.get('number', 0)
-        
-        # 确保段号在有效范围内
-        number_value = min(max(int(number), 0), 35)
-        
-        print(f"设置起始段号：{number_value}")
-        
-        send_command(ser, command_type="custom",
-                    address=0x01,
-                    function=0x06,
-                    register_address=0x0408,  # P4-08地址
-                    data=number_value)
-    
-    elif command_type == "set_segment":
-        # 设置通信段号
-        number = kwargs.get('number', 0)
-        
-        # 确保段号在有效范围内
-        number_value = min(max(int(number), 0), 35)
-        
-        print(f"设置通信段号：{number_value}")
-        
-        send_command(ser, command_type="custom",
-                    address=0x01,
-                    function=0x06,
-                    register_address=0x2209,  # F2-09地址
-                    data=number_value)
-    
-    elif command_type == "clear_alarm":
-        # 清除报警
-        clear = kwargs.get('clear', True)
-        
-        print("清除报警信号")
-        
-        send_command(ser, command_type="custom",
-                    address=0x01,
-                    function=0x06,
-                    register_address=0x2000,  # F0-00地址
-                    data=1 if clear else 0)
-    
+        raw = spec.clamp(kwargs.get(arg, default))
+        prefix = f"第{segment}段" if spec.stride else ""
+        logger.info("设置%s%s：%s", prefix, spec.label, spec.describe(raw))
+        command = spec.raw_command(address, raw, segment)
+        # 关闭使能属于停止指令
+        stop = spec is PROFILE['enable'] and raw == 0
     elif command_type == "custom":
         # 使用自定义指令
-        address = kwargs.get('address', 0x01)
         function = kwargs.get('function', 0x06)
         register_address = kwargs.get('register_address', 0x2105)
         data = kwargs.get('data', 0x0000)
-
-        # 生成命令
         command = generate_rtu_command(address, function, register_address, data)
-        
-        # 发送命令并获取响应
-        response = send_rtu_command(ser, command)
-        
-        # 打印命令内容
-        print(f"发送的自定义命令: {format_rtu_command(command)}")
-        
-        # 解析响应
-        if response:
-            parse_response(response)
-        else:
-            print("未收到响应")
+        stop = False
+    else:
+        logger.error("不支持的命令类型: %s", command_type)
+        return
+
+    # 发送命令并获取响应
+    response = send_rtu_command(ser, command, stop)
+
+    # 打印命令内容
+    logger.debug("发送的命令: %s", HexFrame(command))
+
+    # 解析响应
+    if response:
+        parse_response(response)
+    else:
+        logger.error("%s指令未收到响应", command_type)
+
+
+def split_pulse_count(pulse_count):
+    """将脉冲数拆分为低位、高位两个寄存器值
+    低位范围：-9999~9999，高位范围：-32768~32768，负数使用16位补码表示
+    :param pulse_count: 脉冲数
+    :return: (低位值, 高位值)
+    """
+    return PROFILE['position'].encode_raw(pulse_count)
+
+
+def write_registers(ser, register_address, values, address=0x01):
+    """用功能码0x10写入一段连续寄存器
+    :param ser: 串口对象
+    :param register_address: 起始寄存器地址
+    :param values: 16位寄存器值列表
+    :param address: 通讯地址
+    :return: 写入是否成功（应答回显与请求一致）
+    """
+    command = modbus_rtu.build_write_registers_command(address, register_address, values)
+    response = send_rtu_command(ser, command)
+
+    logger.debug("发送的写多寄存器命令: %s", HexFrame(command))
+
+    if response:
+        parse_response(response)
     else:
-        print(f"不支持的命令类型: {command_type}")
+        logger.error("写入寄存器 %#06X 起 %d 个未收到响应", register_address, len(values))
+    return modbus_rtu.check_write_response(response, address, 0x10, register_address, len(values))
+
+
+def segment_registers(segment_def):
+    """把一段的参数定义转换为{寄存器地址: 值}
+    :param segment_def: 段定义字典，键：
+        - segment: int (段号，1~35)
+        - pulse_count: int (脉冲数，可选)
+        - speed: int (速度，单位：0.1rpm，可选)
+        - acc_time / dec_time / adjust_time: int (单位：ms，可选)
+        - aux: int (段内第6个寄存器，第1段为P4-15，可选)
+    :return: 寄存器映像字典
+    """
+    segment = segment_def.get('segment', 1)
+    image = {}
+    for field, spec in SEGMENT_FIELDS.items():
+        if field in segment_def:
+            image.update(spec.image(segment_def[field], segment))
+    return image
+
+
+def segments_image(segments):
+    """合并多段定义为一个寄存器映像
+    :param segments: 段定义列表，格式见segment_registers
+    :return: 寄存器映像字典
+    """
+    image = {}
+    for segment_def in segments:
+        image.update(segment_registers(segment_def))
+    return image
+
+
+def position_registers(image):
+    """找出映像中各段脉冲数的低位寄存器地址（低位、高位需在同一帧写入）"""
+    return {register for register in image
+            if register >= SEGMENT_BASE and (register - SEGMENT_BASE) % SEGMENT_STRIDE == 0
+            and register + 1 in image}
+
+
+def program_segments(ser, segments, address=0x01, max_registers=modbus_rtu.MAX_WRITE_REGISTERS):
+    """批量设置多段位置参数，连续寄存器合并为尽量少的0x10帧
+    各段定义齐全（含aux）时，相邻段的寄存器首尾相连，35段只需2~3帧；
+    缺少的字段不写入，会在该处把写入块断开。脉冲数的低位、高位总在同一帧中写入。
+    :param ser: 串口对象
+    :param segments: 段定义列表，格式见segment_registers
+    :param address: 通讯地址
+    :param max_registers: 单帧最多写入的寄存器数，可调小以便一帧只写一段
+    :return: 全部写入是否成功
+    """
+    image = segments_image(segments)
+    blocks = modbus_rtu.group_registers(image, max_registers, position_registers(image))
+    logger.info("设置%d段参数，共%d个寄存器，分%d帧写入", len(segments), len(image), len(blocks))
+
+    for register_address, values in blocks:
+        if not write_registers(ser, register_address, values, address):
+            logger.error("写入寄存器 %#06X 起 %d 个失败", register_address, len(values))
+            return False
+    return True
+
+
+# 影子映像覆盖的可写寄存器：(起始地址, 数量)，同时也是回读时的批量读取块（见设备描述）
+SHADOW_BLOCKS = PROFILE.blocks
+
+
+class DS5L2Drive:
+    """带影子寄存器映像的DS5L2驱动器
+    映像记录已确认写入（或回读）的寄存器值，写入时只发送与映像不同的寄存器，
+    并把相邻的待写寄存器合并为0x10帧。写入失败或清除报警(F0-00)后映像失效，
+    需调用resync()回读或重新写入全部参数。
+    """
+
+    def __init__(self, ser, address=0x01, merge_gap=4):
+        """
+        :param ser: 串口对象
+        :param address: 通讯地址
+        :param merge_gap: 两段待写寄存器之间最多间隔几个已知且未变化的寄存器时合并为一帧
+        """
+        self.ser = ser
+        self.address = address
+        self.merge_gap = merge_gap
+        self.shadow = {}
+        self.writable = set()
+        for start, count in SHADOW_BLOCKS:
+            self.writable.update(range(start, start + count))
+
+    def invalidate(self):
+        """清空影子映像，下一次写入将发送全部寄存器"""
+        self.shadow.clear()
+
+    def resync(self):
+        """按块批量回读全部可写寄存器，重建影子映像
+        :return: 回读是否全部成功
+        """
+        self.invalidate()
+        for block_start, block_count in PROFILE.read_plan:
+            command = modbus_rtu.build_read_command(self.address, 0x03, block_start, block_count)
+            values = modbus_rtu.parse_registers(send_rtu_command(self.ser, command))
+            if values is None or len(values) != block_count:
+                logger.error("回读寄存器 %#06X 起 %d 个失败", block_start, block_count)
+                self.invalidate()
+                return False
+            self.shadow.update(zip(range(block_start, block_start + block_count), values))
+        return True
+
+    def diff(self, image):
+        """计算与影子映像不同的寄存器
+        脉冲数的低位、高位任一变化时两者一起写入；间隔不超过merge_gap个已知寄存器时
+        用映像中的值填补空隙，以合并为一帧
+        :param image: 目标寄存器映像
+        :return: 需要写入的寄存器映像
+        """
+        dirty = {register: value for register, value in image.items()
+                 if self.shadow.get(register) != value}
+        for low in position_registers(image):
+            if low in dirty or low + 1 in dirty:
+                dirty[low] = image[low]
+                dirty[low + 1] = image[low + 1]
+
+        registers = sorted(dirty)
+        for previous, register in zip(registers, registers[1:]):
+            gap = range(previous + 1, register)
+            if 0 < len(gap) <= self.merge_gap and all(r in self.shadow for r in gap):
+                for r in gap:
+                    dirty[r] = self.shadow[r]
+        return dirty
+
+    def write(self, image, force=False):
+        """把目标映像写入驱动器，只发送变化的寄存器
+        :param image: {寄存器地址: 值}，地址必须属于可写寄存器
+        :param force: True时忽略影子映像，全部写入
+        :return: 写入是否成功
+        """
+        unknown = set(image) - self.writable
+        if unknown:
+            raise ValueError(f"不可写的寄存器: {', '.join(f'{r:#06X}' for r in sorted(unknown))}")
+
+        dirty = dict(image) if force else self.diff(image)
+        if not dirty:
+            logger.debug("参数与驱动器一致，无需写入")
+            return True
+
+        blocks = modbus_rtu.group_registers(dirty, keep_together=position_registers(dirty))
+        logger.info("写入%d/%d个寄存器，分%d帧", len(dirty), len(image), len(blocks))
+        for register_address, values in blocks:
+            if not write_registers(self.ser, register_address, values, self.address):
+                logger.error("写入寄存器 %#06X 起 %d 个失败，影子映像失效", register_address, len(values))
+                self.invalidate()
+                return False
+            self.shadow.update(zip(range(register_address, register_address + len(values)), values))
+        return True
+
+    def program_segments(self, segments, force=False):
+        """设置多段位置参数，只写入变化的部分，段定义格式见segment_registers"""
+        return self.write(segments_image(segments), force)
+
+    def set_valid_segments(self, count):
+        """设置有效段数(P4-04)"""
+        return self.write(PROFILE['valid_segments'].image(count))
+
+    def set_start_segment(self, number):
+        """设置起始段号(P4-08)"""
+        return self.write(PROFILE['start_segment'].image(number))
+
+    def set_segment(self, number, force=True):
+        """设置通信段号(F2-09)，写入即触发运动，默认总是发送"""
+        return self.write(PROFILE['set_segment'].image(number), force)
+
+    def set_enable(self, enable, force=False):
+        """设置电机使能状态(F1-05)
+        关闭使能属于停止指令：不比较影子映像，总是以最高优先级发送
+        """
+        if enable:
+            return self.write(PROFILE['enable'].image(enable), force)
+        spec = PROFILE['enable']
+        response = send_rtu_command(self.ser, spec.raw_command(self.address, 0), stop=True)
+        if not modbus_rtu.check_write_response(response, self.address, 0x06, spec.address, 0):
+            logger.error("关闭使能失败，影子映像失效")
+            self.invalidate()
+            return False
+        self.shadow.update(spec.image(0))
+        return True
+
+    def clear_alarm(self):
+        """清除报警(F0-00)，驱动器可能复位参数，清除后影子映像失效"""
+        logger.info("清除报警信号")
+        send_command(self.ser, command_type="clear_alarm", address=self.address)
+        self.invalidate()
+
 
 # 配置串口（这里假设RS-485通过COM1口连接，具体口号根据实际情况修改）
 if __name__ == "__main__":
+    modbus_log.setup_logging(level=logging.DEBUG)
     # 配置串口
     ser = configure_serial(port='COM14')
     
@@ -432,4 +505,5 @@ if __name__ == "__main__":
         # 关闭使能
         send_command(ser, command_type="enable", enable=False)
         time.sleep(0.1)
-        ser.close()
\ No newline at end of file
+        ser.close()
+        modbus_log.stop_logging()
\ No newline at end of file
@@ -1,5 +1,16 @@
-import serial
+import logging
 import time
+from typing import NamedTuple
+
+import serial
+
+import device_profiles
+import instrumentation
+import modbus_log
+import modbus_rtu
+from modbus_log import HexFrame
+
+logger = logging.getLogger(__name__)
 
 # 气体类别对应表
 gas_types = {
@@ -71,9 +82,9 @@ def send_data(ser, data):
         # 将数据转换为16进制字符串并发送
         hex_data = bytes.fromhex(data)
         ser.write(hex_data)
-        print(f"发送数据: {data}")
+        logger.debug("发送数据: %s", HexFrame(hex_data))
     except ValueError:
-        print("输入的不是有效的16进制数据!")
+        logger.error("输入的不是有效的16进制数据: %s", data)
 
 
 # 解析设备工作状态
@@ -146,52 +157,194 @@ def parse_gas_type(data):
 
 # 接收数据
 def receive_data(ser, function_code):
-    # 等待数据
-    time.sleep(0.5)  # 延时等待接收数据
-    if ser.in_waiting > 0:
-        received_data = ser.read(ser.in_waiting)
+    # 按帧边界接收应答，完整帧到达即返回
+    received_data = modbus_rtu.read_frame(ser)
+    if received_data:
         received_data_hex = received_data.hex().upper()
-        print(f"接收到数据: {received_data_hex}")
+        logger.debug("接收到数据: %s", received_data_hex)
 
         # 根据第四位（function_code）来判断反馈数据类型
         if function_code == '00':  # 设备工作状态
             status = parse_device_status(received_data)
-            print(f"设备工作状态: {status}")
+            logger.info("设备工作状态: %s", status)
 
         elif function_code == '01':  # 测量气体浓度
             concentration = parse_concentration(received_data)
             if concentration is not None:
-                print(f"气体浓度为: {concentration} 单位：ppm")
+                logger.info("气体浓度为: %s 单位：ppm", concentration)
             else:
-                print("未能解析气体浓度值")
+                logger.warning("未能解析气体浓度值")
 
         elif function_code == '02':  # 设置小数位数
             decimal_places = parse_decimal_places(received_data)
             if decimal_places is not None:
-                print(f"设备小数位数设置为: {decimal_places}")
+                logger.info("设备小数位数设置为: %s", decimal_places)
 
         elif function_code == '03':  # 设备测量单位
             unit = parse_measurement_unit(received_data)
             if unit:
-                print(f"设备测量单位为: {unit}")
+                logger.info("设备测量单位为: %s", unit)
 
         elif function_code == '04':
             # 解析气体类别
             gas_type = parse_gas_type(received_data)
-            print(f"检测气体类别: {gas_type}")
+            logger.info("检测气体类别: %s", gas_type)
 
         else:
-            print("未知功能码")
+            logger.warning("未知功能码: %s", function_code)
 
         # 其他功能的解析可以根据实际协议继续扩展...
 
         return received_data_hex
     else:
-        print("没有接收到数据")
+        logger.error("没有接收到数据")
         return None
 
 
+# 寄存器地址（0x0000~0x0004连续，可一帧读出），见设备描述
+PROFILE = device_profiles.O2
+REG_STATUS = PROFILE['status'].address                  # 设备工作状态
+REG_CONCENTRATION = PROFILE['concentration'].address    # 气体浓度
+REG_GAS_TYPE = PROFILE['gas_type'].address              # 气体类别
+REG_UNIT = PROFILE['unit'].address                      # 测量单位
+REG_DECIMAL_PLACES = PROFILE['decimal_places'].address  # 小数位数
+
+# 工作状态、测量单位对应表
+status_texts = {
+    0: "设备正常工作",
+    1: "低报警",
+    2: "高报警",
+    16: "通信故障",
+}
+unit_texts = {
+    0x01: "ppm",
+    0x02: "ppb",
+}
+
+
+class O2Snapshot(NamedTuple):
+    """一次读取得到的传感器完整数据"""
+    status: int               # 工作状态码
+    status_text: str          # 工作状态说明
+    concentration: float      # 按小数位数换算后的浓度
+    raw_concentration: int    # 寄存器原始浓度值
+    gas_type: int             # 气体类别码
+    gas_name: str             # 气体名称
+    unit: str                 # 测量单位
+    decimal_places: int       # 小数位数
+
+
+STATUS_FAULT = 16  # 通信故障
+
+
+class O2Sensor:
+    """气体传感器驱动，通过0x03读保持寄存器获取数据
+    气体类别、单位、小数位数几乎不变，poll()会缓存这三项，缓存有效期内
+    每个周期只用一帧读取工作状态和浓度两个寄存器
+    """
+
+    def __init__(self, ser, slave=0x01, meta_ttl=60.0, cache=None):
+        """
+        :param ser: 串口对象
+        :param slave: 从机地址
+        :param meta_ttl: 静态参数缓存有效期（秒），None表示只在故障时刷新
+        :param cache: register_cache.RegisterCache，多个任务共享同一传感器读数时使用
+        """
+        self.ser = ser
+        self.slave = slave
+        self.meta_ttl = meta_ttl
+        self.cache = cache
+        self._meta = None  # (气体类别, 单位, 小数位数)
+        self._meta_time = 0.0
+
+    def read_registers(self, register_address, count):
+        """读取连续的保持寄存器
+        :return: 寄存器值元组，失败时返回None
+        """
+        if self.cache is not None:
+            values = self.cache.read(self.slave, register_address, count)
+        else:
+            command = modbus_rtu.build_read_command(self.slave, 0x03, register_address, count)
+            values = modbus_rtu.parse_registers(modbus_rtu.transact(self.ser, command))
+        if values is None or len(values) != count:
+            return None
+        return values
+
+    def _cache_metadata(self, meta):
+        self._meta = tuple(meta)
+        self._meta_time = time.monotonic()
+
+    def invalidate_metadata(self):
+        """使静态参数缓存失效，下次poll()时重新读取"""
+        self._meta = None
+
+    def metadata_valid(self):
+        """静态参数缓存是否仍然有效"""
+        if self._meta is None:
+            return False
+        return self.meta_ttl is None or time.monotonic() - self._meta_time < self.meta_ttl
+
+    def refresh_metadata(self):
+        """一帧读取气体类别、单位、小数位数并缓存
+        :return: 读取是否成功
+        """
+        values = self.read_registers(REG_GAS_TYPE, 3)
+        if values is None:
+            return False
+        self._cache_metadata(values)
+        return True
+
+    def _snapshot(self, status, raw):
+        gas_type, unit, decimal_places = self._meta
+        if instrumentation.enabled:
+            device = f"{getattr(self.ser, 'port', None)}/{self.slave}"
+            instrumentation.set_value('o2_concentration', raw / 10 ** decimal_places, device=device)
+            instrumentation.set_value('o2_status', status, device=device)
+        return O2Snapshot(
+            status=status,
+            status_text=status_texts.get(status, "未知状态"),
+            concentration=raw / 10 ** decimal_places,
+            raw_concentration=raw,
+            gas_type=gas_type,
+            gas_name=gas_types.get(gas_type, "未知气体"),
+            unit=unit_texts.get(unit, "未知单位"),
+            decimal_places=decimal_places,
+        )
+
+    def read_snapshot(self):
+        """一帧读取工作状态、浓度、气体类别、单位、小数位数5个寄存器
+        :return: O2Snapshot，读取失败时返回None
+        """
+        values = self.read_registers(REG_STATUS, 5)
+        if values is None:
+            logger.error("O2传感器（从机%d）没有接收到有效数据", self.slave)
+            return None
+        status, raw = values[:2]
+        self._cache_metadata(values[2:])
+        return self._snapshot(status, raw)
+
+    def poll(self):
+        """周期轮询：静态参数缓存有效时只读工作状态和浓度
+        缓存过期或上次状态为通信故障时，退回一帧读取全部5个寄存器
+        :return: O2Snapshot，读取失败时返回None
+        """
+        if not self.metadata_valid():
+            return self.read_snapshot()
+
+        values = self.read_registers(REG_STATUS, 2)
+        if values is None:
+            logger.error("O2传感器（从机%d）没有接收到有效数据", self.slave)
+            return None
+        status, raw = values
+        snapshot = self._snapshot(status, raw)
+        if status == STATUS_FAULT:
+            # 设备报告故障，下次轮询时重新读取静态参数
+            self.invalidate_metadata()
+        return snapshot
+
+
 if __name__ == "__main__":
+    modbus_log.setup_logging(level=logging.DEBUG)
     # 设置串口端口，替换为你实际的串口号
     port = 'COM12'  # 在Windows中可能是 COM1, COM2 等
     # 这里可以根据你的硬件设置来调整波特率
@@ -221,3 +374,4 @@ if __name__ == "__main__":
 
     finally:
         ser.close()
+        modbus_log.stop_logging()
@@ -1,22 +1,27 @@
+import logging
 import serial
 import time
+from typing import NamedTuple
 
+import device_profiles
+import instrumentation
+import modbus_log
+import modbus_rtu
+from modbus_log import HexFrame
+from modbus_rtu import append_crc
 
-def calculate_crc(data):
-    """计算Modbus CRC-16
-    :param data: 字节数组
-    :return: CRC校验码（2字节，低字节在前）
-    """
-    crc = 0xFFFF
-    for byte in data:
-        crc ^= byte
-        for _ in range(8):
-            if crc & 0x0001:
-                crc = (crc >> 1) ^ 0xA001  # 0xA001是0x8005的反转
-            else:
-                crc = crc >> 1
-    # 返回低字节在前，高字节在后的格式
-    return bytes([crc & 0xFF, crc >> 8])
+logger = logging.getLogger(__name__)
+
+PROFILE = device_profiles.ZS
+
+# 寄存器偏移（40xxx-40001），见设备描述
+REG_STATUS = PROFILE['status'].address    # 40001 运行状态
+REG_ACCEL = PROFILE['accel'].address      # 40150 加减速系数
+REG_FREQ = PROFILE['freq'].address        # 40151 脉冲频率
+REG_MODE = PROFILE['mode'].address        # 40152 工作模式
+REG_CONTROL = PROFILE['control'].address  # 40156 运行控制
+REG_PULSE = PROFILE['pulse'].address      # 40157-40158 脉冲数（高字在前）
+MODE_M20 = 20
 
 
 def build_command(slave_addr, function_code, *data):
@@ -38,64 +43,124 @@ def build_command(slave_addr, function_code, *data):
         # 处理其他功能码
         cmd.extend(data)
     
-    # 计算CRC
-    crc = 0xFFFF
-    for byte in cmd:
-        crc ^= byte
-        for _ in range(8):
-            if crc & 0x0001:
-                crc = (crc >> 1) ^ 0xA001
-            else:
-                crc >>= 1
-    
     # 添加CRC（低字节在前，高字节在后）
-    cmd.append(crc & 0xFF)
-    cmd.append((crc >> 8) & 0xFF)
+    append_crc(cmd)
     
-    print("构建" + hex(function_code) + "指令:", cmd.hex())
-    print("添加CRC后的完整指令:", cmd.hex())
+    logger.debug("构建%#04x指令（含CRC）: %s", function_code, HexFrame(cmd))
     return cmd
 
 
-def wait_motor_stop(ser):
+# 加减速系数每单位对应的加速（或减速）时间，单位秒，需按实际控制器标定
+ACCEL_TIME_PER_UNIT = 0.01
+
+
+def estimate_move_time(freq, pulses, accel):
+    """估算一次定长运动的时间
+    按梯形速度曲线计算：加速、减速各用时accel * ACCEL_TIME_PER_UNIT，
+    脉冲数不足以加速到目标频率时按三角形曲线计算
+    :param freq: 脉冲频率（Hz）
+    :param pulses: 脉冲数
+    :param accel: 加减速系数
+    :return: 预计运动时间（秒）
+    """
+    ramp = accel * ACCEL_TIME_PER_UNIT
+    cruise = pulses / freq
+    if cruise >= ramp:
+        return cruise + ramp
+    # 三角形曲线：到达峰值前即开始减速
+    return 2 * (pulses * ramp / freq) ** 0.5
+
+
+def read_motor_status(ser, slave=1):
+    """读取运行状态寄存器40001
+    :param slave: 从机地址
+    :return: 状态值（0为停止），读取失败时返回None
+    """
+    cmd = modbus_rtu.build_read_command(slave, 3, REG_STATUS, 1)
+    values = modbus_rtu.parse_registers(modbus_rtu.transact(ser, cmd))
+    if not values:
+        return None
+    _publish_status(ser, slave, values[0])
+    return values[0]
+
+
+def _publish_status(ser, slave, status):
+    """把最新运行状态交给统计层（用于指标导出）"""
+    if instrumentation.enabled and status is not None:
+        instrumentation.set_value('motor_status', status, device=f"{getattr(ser, 'port', None)}/{slave}")
+
+
+def wait_motor_stop(ser, expected_time=None, lead=0.05, min_interval=0.01, max_interval=0.2, timeout=None,
+                    slave=1):
     """等待电机完全停止
+    给出预计运动时间时，先休眠到预计结束前，再以逐步加长的间隔快速轮询；
+    超时时间随预计运动时间放大，而不是固定值
+    :param ser: 串口对象
+    :param expected_time: 预计运动时间（秒），None表示未知，立即开始轮询
+    :param lead: 提前于预计结束时间开始轮询的余量（秒）
+    :param min_interval: 初始轮询间隔（秒）
+    :param max_interval: 最大轮询间隔（秒）
+    :param timeout: 超时时间（秒），默认预计时间的2倍再加1秒，未知时为10秒
+    :param slave: 从机地址
     :return: True如果成功停止，False如果超时
     """
-    print("等待电机停止...")
-    reg_status = 0  # 40001-40001=0
-    max_attempts = 10  # 最大等待10秒
-    for _ in range(max_attempts):
-        cmd = build_command(1, 3, reg_status >> 8, reg_status & 0xFF, 0, 1)
-        ser.write(cmd)
-        resp = ser.read(7)
-        if len(resp) >= 5:
-            status = resp[3]
-            if status == 0:
-                print("电机已停止")
-                return True
-        time.sleep(1)
-    print("等待电机停止超时")
+    logger.debug("等待电机停止...")
+    start = time.monotonic()
+    if timeout is None:
+        timeout = 10.0 if expected_time is None else expected_time * 2 + 1.0
+    deadline = start + timeout
+
+    if expected_time:
+        # 预计结束前不占用总线
+        time.sleep(max(expected_time * 0.9 - lead, 0))
+
+    interval = min_interval
+    while True:
+        status = read_motor_status(ser, slave)
+        if status == 0:
+            logger.info("电机已停止，用时%.3fs", time.monotonic() - start)
+            return True
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        time.sleep(min(interval, deadline - now))
+        interval = min(interval * 2, max_interval)
+    logger.error("等待电机停止超时（从机%d）", slave)
     return False
 
 
-def stop_motor(ser):
-    """停止电机并等待完全停止"""
-    reg_control = 155  # 40156-40001=155
-    cmd = build_command(1, 6, reg_control >> 8, reg_control & 0xFF, 0, 0)  # 0=停止
-    ser.write(cmd)
-    print("发送停止指令:", cmd.hex())
-    time.sleep(0.1)
-    print("响应:", ser.read(8).hex())
-    return wait_motor_stop(ser)
+def stop_motor(ser, slave=1):
+    """停止电机并等待完全停止
+    :param slave: 从机地址
+    """
+    cmd = build_command(slave, 6, REG_CONTROL >> 8, REG_CONTROL & 0xFF, 0, 0)  # 0=停止
+    resp = modbus_rtu.transact_stop(ser, cmd)
+    logger.debug("发送停止指令: %s，响应: %s", HexFrame(cmd), HexFrame(resp))
+    return wait_motor_stop(ser, slave=slave)
+
+
+def check_move(direction, freq, pulses, accel):
+    """检查运动参数，不合法时抛出ValueError"""
+    if direction not in [0, 1, 2]:
+        raise ValueError("方向参数必须是0(停止)、1(正转)或2(反转)")
+    if not 1 <= freq <= 30000:
+        raise ValueError("频率必须在1-30000Hz范围内")
+    if not 1 <= accel <= 100:
+        raise ValueError("加减速系数必须在1-100范围内")
+    if pulses < 0:
+        raise ValueError("脉冲数不能为负数")
+    if pulses > 0xFFFFFFFF:
+        raise ValueError("脉冲数超出32位范围")
 
 
-def motor_control(ser, direction=1, freq=1000, pulses=500, accel=1):
+def motor_control(ser, direction=1, freq=1000, pulses=500, accel=1, slave=1):
     """执行完整的电机控制流程
     :param ser: 串口对象
     :param direction: 运行方向：0=停止，1=正转，2=反转
     :param freq: 脉冲频率（1-30000Hz）
     :param pulses: 脉冲数（32位无符号整数）
     :param accel: 加减速系数（1-100）
+    :param slave: 从机地址
     
     寄存器地址说明：
     40152 (151): 工作模式设置
@@ -107,86 +172,295 @@ def motor_control(ser, direction=1, freq=1000, pulses=500, accel=1):
     """
     try:
         # 参数检查
-        if direction not in [0, 1, 2]:
-            raise ValueError("方向参数必须是0(停止)、1(正转)或2(反转)")
-        if not 1 <= freq <= 30000:
-            raise ValueError("频率必须在1-30000Hz范围内")
-        if not 1 <= accel <= 100:
-            raise ValueError("加减速系数必须在1-100范围内")
-        if pulses < 0:
-            raise ValueError("脉冲数不能为负数")
+        check_move(direction, freq, pulses, accel)
 
         # 确保电机停止
-        if not stop_motor(ser):
+        if not stop_motor(ser, slave):
             raise Exception("无法停止电机")
 
         # 1. 设置工作模式为M20 (寄存器40152)
-        reg_mode = 151  # 40152-40001=151
-        mode_m20 = 20
-        cmd = build_command(1, 6, reg_mode >> 8, reg_mode & 0xFF, mode_m20 >> 8, mode_m20 & 0xFF)
-        ser.write(cmd)
-        print(f"设置工作模式为M{mode_m20}，指令:", cmd.hex())
-        time.sleep(0.1)
-        print("响应:", ser.read(8).hex())
+        cmd = PROFILE['mode'].raw_command(slave, MODE_M20)
+        resp = modbus_rtu.transact(ser, cmd)
+        logger.debug("设置工作模式为M%d，指令: %s，响应: %s", MODE_M20, HexFrame(cmd), HexFrame(resp))
 
         # 2. 设置加减速系数 (寄存器40150)
-        reg_accel = 149  # 40150-40001=149
-        cmd = build_command(1, 6, reg_accel >> 8, reg_accel & 0xFF, accel >> 8, accel & 0xFF)
-        ser.write(cmd)
-        print(f"设置加减速系数为{accel}，指令:", cmd.hex())
-        time.sleep(0.1)
-        print("响应:", ser.read(8).hex())
+        cmd = PROFILE['accel'].raw_command(slave, accel)
+        resp = modbus_rtu.transact(ser, cmd)
+        logger.debug("设置加减速系数为%d，指令: %s，响应: %s", accel, HexFrame(cmd), HexFrame(resp))
 
         # 3. 设置脉冲频率 (寄存器40151)
-        reg_freq = 150  # 40151-40001=150
-        cmd = build_command(1, 6, reg_freq >> 8, reg_freq & 0xFF, freq >> 8, freq & 0xFF)
-        ser.write(cmd)
-        print(f"设置脉冲频率为{freq}Hz，指令:", cmd.hex())
-        time.sleep(0.1)
-        print("响应:", ser.read(8).hex())
+        cmd = PROFILE['freq'].raw_command(slave, freq)
+        resp = modbus_rtu.transact(ser, cmd)
+        logger.debug("设置脉冲频率为%dHz，指令: %s，响应: %s", freq, HexFrame(cmd), HexFrame(resp))
 
         # 4. 设置脉冲数 (寄存器40157-40158)
-        reg_pulse = 156  # 40157-40001=156
-        # 将脉冲数转换为4字节数据，高字节在前
-        pulse_bytes = [
-            (pulses >> 24) & 0xFF,  # 最高字节
-            (pulses >> 16) & 0xFF,  # 次高字节
-            (pulses >> 8) & 0xFF,   # 次低字节
-            pulses & 0xFF           # 最低字节
-        ]
-        # 发送写入命令 (功能码0x10，写入2个寄存器)
-        cmd = build_command(1, 0x10, reg_pulse >> 8, reg_pulse & 0xFF, 0, 2, pulse_bytes)
-        ser.write(cmd)
-        print(f"设置脉冲数为{pulses}，指令:", cmd.hex())
-        time.sleep(0.1)
-        resp = ser.read(8)
+        # 脉冲数高字在前，功能码0x10一帧写入2个寄存器
+        cmd = PROFILE['pulse'].raw_command(slave, pulses)
+        resp = modbus_rtu.transact(ser, cmd)
+        logger.debug("设置脉冲数为%d，指令: %s", pulses, HexFrame(cmd))
         if resp:
-            print("响应:", resp.hex())
+            logger.debug("响应: %s", HexFrame(resp))
         else:
-            print("未收到脉冲数设置响应")
+            logger.error("未收到脉冲数设置响应")
             raise Exception("设置脉冲数失败")
 
         # 5. 设置运行方向
         if direction != 0:  # 如果不是停止命令
-            reg_control = 155  # 40156-40001=155
-            cmd = build_command(1, 6, reg_control >> 8, reg_control & 0xFF, 0, direction)
-            ser.write(cmd)
-            print(f"设置电机{'正转' if direction == 1 else '反转'}，指令:", cmd.hex())
-            time.sleep(0.1)
-            print("响应:", ser.read(8).hex())
+            cmd = PROFILE['control'].raw_command(slave, direction)
+            resp = modbus_rtu.transact(ser, cmd)
+            logger.info("设置电机%s", '正转' if direction == 1 else '反转')
+            logger.debug("指令: %s，响应: %s", HexFrame(cmd), HexFrame(resp))
 
             # 6. 监控运行状态直到停止
-            print("监控运行状态...")
-            wait_motor_stop(ser)
+            logger.debug("监控运行状态...")
+            wait_motor_stop(ser, estimate_move_time(freq, pulses, accel), slave=slave)
         else:
-            print("电机保持停止状态")
+            logger.info("电机保持停止状态")
 
     except Exception as e:
-        print(f"控制过程中发生错误: {e}")
+        logger.error("控制过程中发生错误: %s", e)
         raise
 
 
+class ZSController:
+    """带参数缓存的中盛控制器
+    记录最近一次已确认写入的工作模式、加减速系数、频率和脉冲数，只写入变化的寄存器；
+    相邻寄存器（40150-40152、40157-40158）合并为一帧0x10写入。
+    上次读取的状态为停止时，运动前跳过停止步骤。
+    """
+
+    def __init__(self, ser, slave=0x01, cache=None):
+        """
+        :param ser: 串口对象
+        :param slave: 从机地址
+        :param cache: register_cache.RegisterCache，状态读取经缓存，写入后使缓存失效
+        """
+        self.ser = ser
+        self.slave = slave
+        self.cache = cache
+        self.params = {}  # 已确认写入的寄存器 {偏移: 值}
+        self.idle = False  # 上次读取的运行状态是否为停止
+
+    def invalidate(self):
+        """清空参数缓存，下次运动前重新写入全部参数"""
+        self.params.clear()
+        self.idle = False
+
+    def write_registers(self, register, values, cmd=None):
+        """用0x10写入连续寄存器，成功后更新缓存
+        :param cmd: 预先生成的指令，None时现场生成
+        :return: 写入是否成功
+        """
+        if cmd is None:
+            cmd = modbus_rtu.build_write_registers_command(self.slave, register, values)
+        resp = modbus_rtu.transact(self.ser, cmd)
+        if self.cache is not None:
+            self.cache.invalidate(self.slave, register, len(values))
+        logger.debug("写入寄存器%d起%d个，指令: %s", 40001 + register, len(values), HexFrame(cmd))
+        if not modbus_rtu.check_write_response(resp, self.slave, 0x10, register, len(values)):
+            logger.error("写入寄存器%d起%d个失败，响应: %s", 40001 + register, len(values), HexFrame(resp))
+            self.invalidate()
+            return False
+        self.params.update(zip(range(register, register + len(values)), values))
+        return True
+
+    def write_control(self, value, cmd=None):
+        """写运行控制寄存器40156（0:停止, 1:正转, 2:反转）
+        :param cmd: 预先生成的指令，None时现场生成
+        :return: 写入是否成功
+        """
+        if cmd is None:
+            cmd = build_command(self.slave, 6, REG_CONTROL >> 8, REG_CONTROL & 0xFF, value >> 8, value & 0xFF)
+        if value == 0:
+            # 停止指令经调度器时插队到所有轮询之前
+            resp = modbus_rtu.transact_stop(self.ser, cmd)
+        else:
+            resp = modbus_rtu.transact(self.ser, cmd)
+        if self.cache is not None:
+            # 控制指令会改变运行状态
+            self.cache.invalidate(self.slave, REG_STATUS, 1)
+            self.cache.invalidate(self.slave, REG_CONTROL, 1)
+        logger.debug("写运行控制%d，响应: %s", value, HexFrame(resp))
+        self.idle = False
+        return modbus_rtu.check_write_response(resp, self.slave, 6, REG_CONTROL, value)
+
+    def read_status(self):
+        """读取运行状态并记录是否停止
+        :return: 状态值，读取失败时返回None
+        """
+        if self.cache is not None:
+            values = self.cache.read(self.slave, REG_STATUS, 1)
+            status = values[0] if values else None
+            _publish_status(self.ser, self.slave, status)
+        else:
+            status = read_motor_status(self.ser, self.slave)
+        self.idle = status == 0
+        return status
+
+    def stop(self):
+        """停止电机并等待完全停止"""
+        if not self.write_control(0):
+            return False
+        self.idle = wait_motor_stop(self.ser, slave=self.slave)
+        return self.idle
+
+    def plan_writes(self, freq, pulses, accel, mode=MODE_M20, params=None):
+        """计算需要写入的寄存器块
+        :param params: 作为比较基准的已写入参数，默认为当前缓存
+        :return: (寄存器块列表[(起始偏移, [值, ...]), ...], 写入后的参数映像)
+        """
+        if params is None:
+            params = self.params
+        image = {
+            REG_ACCEL: accel,
+            REG_FREQ: freq,
+            REG_MODE: mode,
+            **PROFILE['pulse'].image(pulses),
+        }
+        dirty = {reg: value for reg, value in image.items() if params.get(reg) != value}
+        if REG_PULSE in dirty or REG_PULSE + 1 in dirty:
+            # 32位脉冲数两个字一起写入
+            dirty[REG_PULSE] = image[REG_PULSE]
+            dirty[REG_PULSE + 1] = image[REG_PULSE + 1]
+        return modbus_rtu.group_registers(dirty, keep_together={REG_PULSE}), image
+
+    def configure(self, freq, pulses, accel, mode=MODE_M20):
+        """写入运动参数，只发送与缓存不同的寄存器
+        :return: 写入是否成功
+        """
+        blocks, _ = self.plan_writes(freq, pulses, accel, mode)
+        for register, values in blocks:
+            if not self.write_registers(register, values):
+                return False
+        return True
+
+    def move(self, direction=1, freq=1000, pulses=500, accel=1, wait=True):
+        """执行一次运动，参数含义同motor_control
+        :param wait: 是否等待运动结束
+        :return: 运动是否成功完成（wait=False时表示是否成功启动）
+        """
+        check_move(direction, freq, pulses, accel)
+
+        # 上次读到的状态为停止时无需再发停止指令
+        if not self.idle and not self.stop():
+            raise Exception("无法停止电机")
+
+        if not self.configure(freq, pulses, accel):
+            raise Exception("设置运动参数失败")
+
+        if direction == 0:
+            logger.info("电机保持停止状态")
+            return True
+
+        logger.info("设置电机%s", '正转' if direction == 1 else '反转')
+        if not self.write_control(direction):
+            raise Exception("启动电机失败")
+        if not wait:
+            return True
+        self.idle = wait_motor_stop(self.ser, estimate_move_time(freq, pulses, accel), slave=self.slave)
+        return self.idle
+
+    def prepare(self, move, params=None):
+        """预先检查一次运动并生成全部指令帧
+        :param move: Move或(direction, freq, pulses, accel)
+        :param params: 执行该运动前控制器中的参数，默认为当前缓存
+        :return: PreparedMove
+        """
+        move = Move(*move)
+        check_move(*move)
+        blocks, image = self.plan_writes(move.freq, move.pulses, move.accel, params=params)
+        writes = [(register, values, modbus_rtu.build_write_registers_command(self.slave, register, values))
+                  for register, values in blocks]
+        start_cmd = None
+        if move.direction != 0:
+            start_cmd = build_command(self.slave, 6, REG_CONTROL >> 8, REG_CONTROL & 0xFF, 0, move.direction)
+        return PreparedMove(move, writes, start_cmd, image,
+                            estimate_move_time(move.freq, move.pulses, move.accel))
+
+    def start_prepared(self, prepared):
+        """发送预先生成的参数帧和启动帧
+        :return: 是否成功启动
+        """
+        for register, values, cmd in prepared.writes:
+            if not self.write_registers(register, values, cmd):
+                return False
+        if prepared.start_cmd is None:
+            return True
+        return self.write_control(prepared.move.direction, prepared.start_cmd)
+
+    def run_moves(self, moves):
+        """按顺序执行一组运动
+        当前运动进行期间预先生成并检查下一次运动的指令帧（只包含与本次不同的参数），
+        检测到运动结束后立即发送，缩短两次运动之间的空闲时间
+        :param moves: Move或(direction, freq, pulses, accel)的列表
+        :return: 每次运动的时间统计列表，单位秒：
+                 dead_time 上次运动结束到本次启动完成，run_time 启动完成到检测到停止，
+                 expected 预计运动时间
+        """
+        moves = [Move(*move) for move in moves]
+        report = []
+        if not moves:
+            return report
+
+        # 全部运动先检查一遍，避免执行到一半才发现参数错误
+        for move in moves:
+            check_move(*move)
+
+        if not self.idle and not self.stop():
+            raise Exception("无法停止电机")
+
+        prepared = self.prepare(moves[0])
+        last_done = time.monotonic()
+        for index in range(len(moves)):
+            if not self.start_prepared(prepared):
+                raise Exception(f"第{index + 1}次运动启动失败")
+            started = time.monotonic()
+
+            # 电机运行期间准备下一次运动，以本次写入后的参数为基准
+            next_prepared = None
+            if index + 1 < len(moves):
+                next_prepared = self.prepare(moves[index + 1], params=prepared.image)
+
+            if prepared.start_cmd is None:
+                done = started
+            else:
+                self.idle = wait_motor_stop(self.ser, prepared.expected_time, slave=self.slave)
+                if not self.idle:
+                    raise Exception(f"第{index + 1}次运动等待停止超时")
+                done = time.monotonic()
+
+            report.append({
+                'move': prepared.move,
+                'dead_time': started - last_done,
+                'run_time': done - started,
+                'expected': prepared.expected_time,
+            })
+            logger.info("第%d次运动：空闲%.1fms，运行%.3fs（预计%.3fs）",
+                        index + 1, (started - last_done) * 1000, done - started, prepared.expected_time)
+            last_done = done
+            prepared = next_prepared
+        return report
+
+
+class Move(NamedTuple):
+    """一次定长运动"""
+    direction: int  # 0=停止，1=正转，2=反转
+    freq: int       # 脉冲频率（Hz）
+    pulses: int     # 脉冲数
+    accel: int      # 加减速系数
+
+
+class PreparedMove(NamedTuple):
+    """预先生成指令帧的运动"""
+    move: Move
+    writes: list           # [(起始偏移, [值, ...], 指令), ...]
+    start_cmd: bytearray  # 启动指令，停止运动时为None
+    image: dict            # 执行后控制器中的参数
+    expected_time: float   # 预计运动时间（秒）
+
+
 if __name__ == "__main__":
+    modbus_log.setup_logging(level=logging.DEBUG)
     try:
         # 尝试打开串口
         ser = serial.Serial('COM12', 9600, timeout=1)
@@ -208,4 +482,5 @@ if __name__ == "__main__":
         traceback.print_exc()
     finally:
         ser.close()
-        print("串口已关闭")
\ No newline at end of file
+        print("串口已关闭")
+        modbus_log.stop_logging()
\ No newline at end of file
@@ -2,18 +2,8 @@ import serial
 import struct
 import time
 
-
-# CRC校验函数，采用Modbus CRC-16标准
-def calculate_crc(data: bytearray) -> bytearray:
-    crc_value = 0xFFFF
-    for byte in data:
-        crc_value ^= byte
-        for _ in range(8):
-            if crc_value & 0x0001:
-                crc_value = (crc_value >> 1) ^ 0xA001
-            else:
-                crc_value >>= 1
-    return struct.pack('<H', crc_value)
+import modbus_rtu
+from modbus_rtu import calculate_crc  # CRC校验函数，采用Modbus CRC-16标准（查表法）
 
 
 # 生成Modbus RTU命令
@@ -48,10 +38,8 @@ def configure_serial(port, baudrate=9600, timeout=1):
 
 # 发送RTU命令并接收响应
 def send_rtu_command(ser, command):
-    ser.write(command)  # 发送命令
-    time.sleep(0.1)  # 等待响应时间
-    response = ser.read(ser.in_waiting)  # 读取所有返回数据
-    return response
+    # 发送命令，按帧边界接收完整应答（不再固定延时）
+    return modbus_rtu.transact(ser, command)
 
 
 # 格式化输出RTU命令
@@ -94,37 +82,46 @@ def parse_response(response: bytearray):
         print(f"数据内容: {data:#06X}")
 
 
-# 配置串口
-ser = configure_serial(port='/dev/ttyUSB0')
+def main(port='/dev/ttyUSB0', duration=10):
+    """连续发送同一条指令duration秒并打印应答
+    :param port: 串口号
+    :param duration: 持续时间（秒）
+    """
+    # 配置串口
+    ser = configure_serial(port=port)
+
+    # 可编辑的参数
+    address = 0x01  # 通讯地址
+    function = 0x06  # 功能码
+    register_address = 0x2100  # 寄存器地址（16位）
+    data = 0x0000  # 数据内容（16位）
+
+    # 生成RTU命令
+    rtu_command = generate_rtu_command(address, function, register_address, data)
 
-# 可编辑的参数
-address = 0x01  # 通讯地址
-function = 0x06  # 功能码
-register_address = 0x2100  # 寄存器地址（16位）
-data = 0x0000  # 数据内容（16位）
+    # 打印生成的RTU命令
+    formatted_command = format_rtu_command(rtu_command)
+    print(f"RTU Command: {formatted_command}")
 
-# 生成RTU命令
-rtu_command = generate_rtu_command(address, function, register_address, data)
+    # 持续发送duration秒
+    start_time = time.time()  # 记录开始时间
+    while time.time() - start_time < duration:
+        # 发送RTU命令并接收响应
+        response = send_rtu_command(ser, rtu_command)
 
-# 打印生成的RTU命令
-formatted_command = format_rtu_command(rtu_command)
-print(f"RTU Command: {formatted_command}")
+        # 打印响应
+        if response:
+            print(f"Response: {response.hex()}")
+            parse_response(response)
+        else:
+            print("No response received.")
 
-# 持续发送10秒
-start_time = time.time()  # 记录开始时间
-while time.time() - start_time < 10:  # 持续10秒
-    # 发送RTU命令并接收响应
-    response = send_rtu_command(ser, rtu_command)
+        time.sleep(0.001)  # 每次发送后等待1毫秒
 
-    # 打印响应
-    if response:
-        print(f"Response: {response.hex()}")
-        parse_response(response)
-    else:
-        print("No response received.")
+    # 关闭串口
+    ser.close()
+    print("串口已关闭。")
 
-    time.sleep(0.001)  # 每次发送后等待100毫秒
 
-# 关闭串口
-ser.close()
-print("串口已关闭。")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -4,30 +4,35 @@ import time
 import socket
 import os
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from pymodbus.client import ModbusTcpClient
 import logging
 
 # 导入其他模块
-import modbus_IO
-import modbus_temp
-import modbus_valve
-# import TEST
-import _485_DS5L2 as ds5l2
-import _485_O2 as o2
-import _485_ZS as zs
-
-# 配置更详细的日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('modbus_test.log'),
-        logging.StreamHandler()
-    ]
-)
+import drivers
+import frame_capture
+import instrumentation
+import metrics_exporter
+import modbus_log
+import modbus_tcp
+
+# 设备驱动在第一次使用时才加载，导入本模块不做任何通信
+ds5l2 = drivers.lazy('ds5l2')
+o2 = drivers.lazy('o2')
+zs = drivers.lazy('zs')
+modbus_IO = drivers.lazy('io')
+modbus_valve = drivers.lazy('valve')
+
 logger = logging.getLogger(__name__)
 
+
+def setup_logging():
+    """配置更详细的日志（在main中调用，导入本模块时不创建日志文件）
+    写文件和控制台都在后台线程中进行，测试线程只把日志记录放入队列
+    """
+    modbus_log.setup_logging(level=logging.INFO, log_file='modbus_test.log')
+
 class ModbusTestSystem:
     def __init__(self, log_dir='test_reports'):
         # 串口设备配置
@@ -47,8 +52,10 @@ class ModbusTestSystem:
         self.zs_ser = None
         
         # 初始化TCP连接
-        self.io_client = None
-        self.valve_client = None
+        self.io_transport = None
+        self.io_module = None
+        self.valve_transport = None
+        self.valve_island = None
 
         # 测试结果追踪
         self.test_results = {
@@ -61,13 +68,19 @@ class ModbusTestSystem:
             'valve_module': False
         }
 
+        # 各测试耗时（秒）及并行执行时的关键路径
+        self.test_timings = {}
+        self.critical_path = None
+        self._results_lock = threading.Lock()
+
         # 日志目录
         self.log_dir = log_dir
         os.makedirs(self.log_dir, exist_ok=True)
 
     def _log_test_result(self, test_name, result):
-        """记录测试结果"""
-        self.test_results[test_name] = result
+        """记录测试结果（可能在多个总线线程中同时调用）"""
+        with self._results_lock:
+            self.test_results[test_name] = result
         log_message = f"{test_name} 测试 {'成功' if result else '失败'}"
         logger.info(log_message)
 
@@ -76,6 +89,9 @@ class ModbusTestSystem:
         report_data = {
             'timestamp': datetime.now().isoformat(),
             'test_results': self.test_results,
+            'test_timings': self.test_timings,
+            'critical_path': self.critical_path,
+            'transaction_stats': instrumentation.snapshot(),
             'overall_result': all(self.test_results.values())
         }
 
@@ -136,19 +152,21 @@ class ModbusTestSystem:
     def init_tcp_devices(self):
         """初始化TCP设备"""
         try:
-            # 初始化IO模块TCP客户端
-            self.io_client = ModbusTcpClient(self.io_host, port=self.modbus_port)
-            if not self.io_client.connect():
+            # 初始化IO模块TCP传输及8路线圈驱动（与温度模块同一网关，共用连接池中的连接）
+            self.io_transport = modbus_tcp.get_transport(self.io_host, self.modbus_port)
+            if not self.io_transport.connect():
                 logger.error("IO模块连接失败")
                 self._log_test_result('tcp_devices', False)
                 return False
+            self.io_module = modbus_IO.IOModule(self.io_transport, unit_id=0x01, coil_count=8)
 
-            # 初始化阀门控制器TCP客户端
-            self.valve_client = ModbusTcpClient(self.valve_host, port=self.modbus_port)
-            if not self.valve_client.connect():
+            # 初始化阀门控制器TCP传输及8路阀岛驱动
+            self.valve_transport = modbus_tcp.get_transport(self.valve_host, self.modbus_port)
+            if not self.valve_transport.connect():
                 logger.error("阀门控制器连接失败")
                 self._log_test_result('tcp_devices', False)
                 return False
+            self.valve_island = modbus_valve.ValveIsland(self.valve_transport, unit_id=0x01, valve_count=8)
 
             self._log_test_result('tcp_devices', True)
             return True
@@ -183,7 +201,8 @@ class ModbusTestSystem:
         - clear_alarm: 清除电机可能存在的报警状态
         - enable: 最终使能电机，使其可以执行运动
         
-        每个命令之间添加0.5秒延时，确保电机能够正确响应每个指令
+        第1段的位置、速度、加减速时间、调整时间通过program_segments合并为一帧0x10写入，
+        各命令按帧边界接收应答后立即发送下一条，不再额外延时
         
         Returns:
             bool: 测试是否成功
@@ -194,35 +213,19 @@ class ModbusTestSystem:
         try:
             # 1. 设置有效段数为1段
             ds5l2.send_command(self.ds5l2_ser, "valid_segments", count=1)
-            time.sleep(0.5)
 
             # 2. 设置起始段号为0
             ds5l2.send_command(self.ds5l2_ser, "start_segment", number=0)
-            time.sleep(0.5)
-
-            # 3. 第1段位置控制，目标脉冲数1000
-            ds5l2.send_command(self.ds5l2_ser, "position", pulse_count=1000, segment=1)
-            time.sleep(0.5)
-
-            # 4. 第1段速度控制，速度500
-            ds5l2.send_command(self.ds5l2_ser, "speed", speed=500, segment=1)
-            time.sleep(0.5)
-
-            # 5. 第1段加速时间，500ms
-            ds5l2.send_command(self.ds5l2_ser, "acc_time", time_ms=500, segment=1)
-            time.sleep(0.5)
 
-            # 6. 第1段减速时间，500ms
-            ds5l2.send_command(self.ds5l2_ser, "dec_time", time_ms=500, segment=1)
-            time.sleep(0.5)
-
-            # 7. 第1段调整时间，100ms
-            ds5l2.send_command(self.ds5l2_ser, "adjust_time", time_ms=100, segment=1)
-            time.sleep(0.5)
+            # 3-7. 第1段：目标脉冲数1000，速度500，加/减速时间500ms，调整时间100ms
+            if not ds5l2.program_segments(self.ds5l2_ser, [
+                {'segment': 1, 'pulse_count': 1000, 'speed': 500,
+                 'acc_time': 500, 'dec_time': 500, 'adjust_time': 100},
+            ]):
+                raise Exception("第1段参数写入失败")
 
             # 8. 清除报警状态
             ds5l2.send_command(self.ds5l2_ser, "clear_alarm", clear=True)
-            time.sleep(0.5)
 
             # 9. 最后使能电机，准备执行运动
             ds5l2.send_command(self.ds5l2_ser, "enable", enable=True)
@@ -237,25 +240,12 @@ class ModbusTestSystem:
     def test_o2_sensor(self):
         """测试O2传感器功能"""
         try:
-            # 1. 获取设备工作状态
-            o2.send_data(self.o2_ser, '01 03 00 00 00 01 84 0A')
-            status_data = o2.receive_data(self.o2_ser, '00')
-            
-            # 2. 读取气体浓度
-            o2.send_data(self.o2_ser, '01 03 00 01 00 01 D4 0A')
-            concentration_data = o2.receive_data(self.o2_ser, '01')
-            
-            # 3. 读取气体类别
-            o2.send_data(self.o2_ser, '01 03 00 02 00 01 25 CA')
-            gas_type_data = o2.receive_data(self.o2_ser, '04')
-            
-            # 4. 读取测量单位
-            o2.send_data(self.o2_ser, '01 03 00 03 00 01 74 0A')
-            unit_data = o2.receive_data(self.o2_ser, '03')
-            
-            # 5. 读取小数位数
-            o2.send_data(self.o2_ser, '01 03 00 04 00 01 C4 0B')
-            decimal_data = o2.receive_data(self.o2_ser, '02')
+            # 一帧读取工作状态、浓度、气体类别、单位、小数位数
+            snapshot = o2.O2Sensor(self.o2_ser).read_snapshot()
+            if snapshot is None:
+                raise Exception("O2传感器无有效应答")
+            logger.info(f"O2传感器: {snapshot.status_text}，{snapshot.gas_name} "
+                        f"{snapshot.concentration} {snapshot.unit}")
             
             self._log_test_result('o2_sensor', True)
             return True
@@ -267,29 +257,34 @@ class ModbusTestSystem:
     def test_zs_motor(self):
         """测试ZS电机控制功能"""
         try:
-            # 1. 正转测试
-            zs.motor_control(
-                self.zs_ser, 
-                direction=1,    # 正转
-                freq=1000,      # 脉冲频率1000Hz
-                pulses=500,     # 500个脉冲
-                accel=50        # 加减速系数50
-            )
-            time.sleep(1)
-
-            # 2. 反转测试
-            zs.motor_control(
-                self.zs_ser, 
-                direction=2,    # 反转
-                freq=800,       # 脉冲频率800Hz
-                pulses=300,     # 300个脉冲
-                accel=30        # 加减速系数30
-            )
-            time.sleep(1)
+            # 控制器缓存已写入的参数，两次运动只发送变化的寄存器
+            controller = zs.ZSController(self.zs_ser)
+
+            steps = [
+                # 1. 正转测试
+                ('正转', lambda: controller.move(
+                    direction=1,    # 正转
+                    freq=1000,      # 脉冲频率1000Hz
+                    pulses=500,     # 500个脉冲
+                    accel=50        # 加减速系数50
+                )),
+                # 2. 反转测试
+                ('反转', lambda: controller.move(
+                    direction=2,    # 反转
+                    freq=800,       # 脉冲频率800Hz
+                    pulses=300,     # 300个脉冲
+                    accel=30        # 加减速系数30
+                )),
+                # 3. 停止测试
+                ('停止', controller.stop),
+            ]
+            for name, step in steps:
+                # 写入失败或等待停止超时都返回False
+                if not step():
+                    logger.error(f"ZS电机{name}测试失败")
+                    self._log_test_result('zs_motor', False)
+                    return False
 
-            # 3. 停止测试
-            zs.stop_motor(self.zs_ser)
-            
             self._log_test_result('zs_motor', True)
             return True
         except Exception as e:
@@ -300,40 +295,27 @@ class ModbusTestSystem:
     def test_io_module(self):
         """测试IO模块功能"""
         try:
-            # 检查IO客户端是否已连接
-            if not self.io_client or not self.io_client.is_socket_open():
+            # 检查IO模块是否已连接
+            if not self.io_module or not self.io_transport.is_open():
                 logger.error("IO模块未连接，请先初始化TCP设备")
                 self._log_test_result('io_module', False)
                 return False
 
-            # 测试地址1-8的开关
+            # 批量读取当前线圈状态
+            self.io_module.refresh()
+
+            # 依次只开启地址1-8中的一路：每步关闭上一路、开启下一路在同一帧0x0F中完成
             for addr in range(1, 9):
-                # 开启线圈
-                result_on = modbus_IO.send_modbus_command(
-                    self.io_client, 
-                    unit_id=0x01, 
-                    function_code=0x05, 
-                    address=addr-1,  # Modbus地址从0开始 
-                    data=0xFF00     # 开启
-                )
-                time.sleep(0.5)
-
-                # 关闭线圈
-                result_off = modbus_IO.send_modbus_command(
-                    self.io_client, 
-                    unit_id=0x01, 
-                    function_code=0x05, 
-                    address=addr-1,  # Modbus地址从0开始
-                    data=0x0000     # 关闭
-                )
-                time.sleep(0.5)
-
-                # 检查是否全部成功
-                if not (result_on and result_off):
+                self.io_module.apply(1 << (addr - 1))
+                if self.io_module.mask() != 1 << (addr - 1):
                     logger.error(f"地址{addr}的IO控制失败")
                     self._log_test_result('io_module', False)
                     return False
 
+            # 全部开启、全部关闭各一帧
+            self.io_module.apply(0xFF)
+            self.io_module.apply(0x00)
+
             self._log_test_result('io_module', True)
             return True
         except Exception as e:
@@ -344,37 +326,19 @@ class ModbusTestSystem:
     def test_valve_module(self):
         """测试阀门模块功能"""
         try:
-            # 检查阀门客户端是否已连接
-            if not self.valve_client or not self.valve_client.is_socket_open():
+            # 检查阀门模块是否已连接
+            if not self.valve_island or not self.valve_transport.is_open():
                 logger.error("阀门模块未连接，请先初始化TCP设备")
                 self._log_test_result('valve_module', False)
                 return False
 
-            # 测试地址1-8的阀门开关
+            # 依次只开启阀门1-8中的一个，每步整组状态一帧写入
             for addr in range(1, 9):
-                # 开启阀门
-                result_on = modbus_valve.send_valve_command(
-                    self.valve_client, 
-                    unit_id=0x01, 
-                    address=addr-1,  # Modbus地址从0开始 
-                    data=0x0101     # 开启
-                )
-                time.sleep(0.5)
-
-                # 关闭阀门
-                result_off = modbus_valve.send_valve_command(
-                    self.valve_client, 
-                    unit_id=0x01, 
-                    address=addr-1,  # Modbus地址从0开始
-                    data=0x0000     # 关闭
-                )
-                time.sleep(0.5)
-
-                # 检查是否全部成功
-                if not (result_on and result_off):
-                    logger.error(f"地址{addr}的阀门控制失败")
-                    self._log_test_result('valve_module', False)
-                    return False
+                self.valve_island.set_mask(1 << (addr - 1))
+
+            # 全部开启、全部关闭各一帧
+            self.valve_island.set_mask(0xFF)
+            self.valve_island.close_all()
 
             self._log_test_result('valve_module', True)
             return True
@@ -383,6 +347,68 @@ class ModbusTestSystem:
             self._log_test_result('valve_module', False)
             return False
 
+    def test_groups(self):
+        """按物理总线对测试分组，同一总线上的测试按顺序执行
+        :return: {总线名称: [测试方法, ...]}
+        """
+        groups = {}
+        for bus, test_method in [
+            (self.ds5l2_port, self.test_ds5l2_motor),
+            (self.o2_port, self.test_o2_sensor),
+            (self.io_host, self.test_io_module),
+            (self.valve_host, self.test_valve_module),
+            (self.zs_port, self.test_zs_motor),
+        ]:
+            groups.setdefault(bus, []).append(test_method)
+        return groups
+
+    def _run_timed(self, test_method):
+        """执行单个测试并记录耗时"""
+        start = time.perf_counter()
+        try:
+            test_method()
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._results_lock:
+                self.test_timings[test_method.__name__] = round(elapsed, 3)
+        return elapsed
+
+    def _run_group(self, bus, test_methods):
+        """按顺序执行同一总线上的测试
+        :return: (总线名称, 总耗时)
+        """
+        return bus, sum(self._run_timed(test_method) for test_method in test_methods)
+
+    def run_tests_sequential(self):
+        """逐个执行全部测试"""
+        for test_methods in self.test_groups().values():
+            for test_method in test_methods:
+                self._run_timed(test_method)
+
+    def run_tests_parallel(self, max_workers=None):
+        """不同总线的测试分组并行执行，同一总线内保持顺序
+        总耗时由最慢的一组决定（关键路径）
+        :param max_workers: 线程数，默认每个总线一个线程
+        """
+        groups = self.test_groups()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers or len(groups)) as executor:
+            group_times = dict(executor.map(lambda item: self._run_group(*item), groups.items()))
+        wall_time = time.perf_counter() - start
+
+        bus = max(group_times, key=group_times.get)
+        self.critical_path = {
+            'bus': bus,
+            'tests': [test_method.__name__ for test_method in groups[bus]],
+            'time': round(group_times[bus], 3),
+            'wall_time': round(wall_time, 3),
+            'serial_time': round(sum(group_times.values()), 3),
+        }
+        for name, elapsed in self.test_timings.items():
+            logger.info(f"{name} 耗时 {elapsed:.3f}s")
+        logger.info(f"并行执行总耗时 {wall_time:.3f}s（顺序执行需 {self.critical_path['serial_time']:.3f}s），"
+                    f"关键路径: {bus} {self.critical_path['tests']}")
+
     def close_all_connections(self):
         """关闭所有连接并生成测试报告"""
         try:
@@ -392,11 +418,9 @@ class ModbusTestSystem:
                     ser.close()
                     logger.info(f"已关闭串口: {ser.port}")
 
-            # 关闭TCP连接
-            for client in [self.io_client, self.valve_client]:
-                if client:
-                    client.close()
-                    logger.info(f"已关闭TCP连接: {client}")
+            # 关闭连接池中的全部TCP连接
+            modbus_tcp.default_pool.close_all()
+            logger.info("已关闭TCP连接")
 
             # 生成测试报告
             report_path = self._generate_test_report()
@@ -405,32 +429,44 @@ class ModbusTestSystem:
             logger.error(f"关闭连接时发生错误: {e}", exc_info=True)
             return None
 
-def main():
-    system = ModbusTestSystem()
-    
-    # 初始化设备
-    if not system.init_serial_devices():
-        logger.error("串口设备初始化失败")
-        return
-    
-    if not system.init_tcp_devices():
-        logger.error("TCP设备初始化失败")
-        return
-
-    # 执行测试
-    test_methods = [
-        system.test_ds5l2_motor,
-        system.test_o2_sensor,
-        system.test_io_module,
-        system.test_valve_module,
-        system.test_zs_motor
-    ]
-
-    for test_method in test_methods:
-        test_method()
-
-    # 关闭连接并生成报告
-    system.close_all_connections()
+def main(parallel=True, stats=True, metrics_port=None, capture_file=None):
+    """
+    :param parallel: 不同总线是否并行测试
+    :param stats: 是否记录每个事务的延迟统计（写入测试报告）
+    :param metrics_port: 指定端口时在本机提供Prometheus指标（/metrics），None表示不启动
+    :param capture_file: 指定文件时把收发的每一帧追加写入该抓包文件（见frame_capture），None表示不抓包
+    """
+    setup_logging()
+    if capture_file is not None:
+        frame_capture.start_capture(capture_file)
+    if stats:
+        instrumentation.enable()
+    if metrics_port is not None:
+        metrics_exporter.start_exporter(port=metrics_port)
+    try:
+        system = ModbusTestSystem()
+
+        # 初始化设备
+        if not system.init_serial_devices():
+            logger.error("串口设备初始化失败")
+            return
+
+        if not system.init_tcp_devices():
+            logger.error("TCP设备初始化失败")
+            return
+
+        # 执行测试：不同总线并行，同一总线内按顺序
+        if parallel:
+            system.run_tests_parallel()
+        else:
+            system.run_tests_sequential()
+
+        # 关闭连接并生成报告
+        system.close_all_connections()
+    finally:
+        frame_capture.stop_capture()
+        # 写完队列中剩余的日志
+        modbus_log.stop_logging()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,144 @@
+import time
+
+import modbus_rtu
+
+
+class SlaveState:
+    """单个从机的轮询状态及响应时间统计"""
+
+    def __init__(self, slave, command, callback):
+        self.slave = slave
+        self.command = bytes(command)
+        self.callback = callback
+        self.next_poll = 0.0
+        self.failures = 0   # 连续无应答次数
+        self.polls = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.last_time = None
+        self.min_time = None
+        self.max_time = None
+        self.total_time = 0.0
+
+    def record(self, elapsed):
+        self.responses += 1
+        self.last_time = elapsed
+        self.total_time += elapsed
+        self.min_time = elapsed if self.min_time is None else min(self.min_time, elapsed)
+        self.max_time = elapsed if self.max_time is None else max(self.max_time, elapsed)
+
+    def report(self):
+        return {
+            'slave': self.slave,
+            'polls': self.polls,
+            'responses': self.responses,
+            'timeouts': self.timeouts,
+            'consecutive_failures': self.failures,
+            'last_ms': None if self.last_time is None else round(self.last_time * 1000, 2),
+            'avg_ms': round(self.total_time / self.responses * 1000, 2) if self.responses else None,
+            'min_ms': None if self.min_time is None else round(self.min_time * 1000, 2),
+            'max_ms': None if self.max_time is None else round(self.max_time * 1000, 2),
+        }
+
+
+class BusPoller:
+    """单条RS-485线路上的多从机轮询
+    依次轮询各从机；无应答的从机按指数退避推迟下一次轮询，
+    避免掉线节点的超时占满总线，恢复应答后立即回到正常周期
+    """
+
+    def __init__(self, ser, base_backoff=0.5, max_backoff=30.0, response_timeout=None):
+        """
+        :param ser: 串口对象或bus_scheduler.BusChannel
+        :param base_backoff: 首次无应答后的退避时间（秒），之后每次翻倍
+        :param max_backoff: 最长退避时间（秒）
+        :param response_timeout: 轮询事务的应答超时（秒），只在每次轮询期间生效，结束后恢复串口原设置，
+                                 None表示使用串口原设置；串口由总线调度器管理时由调度器决定，不能指定
+        """
+        if response_timeout is not None and hasattr(ser, 'scheduled_transact'):
+            raise ValueError("串口由总线调度器管理，应答超时请在串口上设置")
+        self.ser = ser
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.response_timeout = response_timeout
+        self.slaves = {}
+
+    def add_slave(self, slave, command, callback=None):
+        """添加轮询的从机
+        :param slave: 从机地址
+        :param command: 每次轮询发送的完整请求帧
+        :param callback: 收到有效应答后调用callback(slave, response)
+        """
+        self.slaves[slave] = SlaveState(slave, command, callback)
+
+    def add_register_poll(self, slave, register_address, count, function=0x03, callback=None):
+        """添加读寄存器轮询的从机"""
+        self.add_slave(slave, modbus_rtu.build_read_command(slave, function, register_address, count), callback)
+
+    def poll_slave(self, state):
+        """轮询一个从机
+        :return: 有效应答，无应答或应答无效时返回None
+        """
+        state.polls += 1
+        start = time.monotonic()
+        if self.response_timeout is None:
+            response = modbus_rtu.transact(self.ser, state.command)
+        else:
+            # 只在本次事务中使用轮询的超时，不改变其他驱动共用的串口设置
+            timeout, self.ser.timeout = self.ser.timeout, self.response_timeout
+            try:
+                response = modbus_rtu.transact(self.ser, state.command)
+            finally:
+                self.ser.timeout = timeout
+        elapsed = time.monotonic() - start
+
+        if response and response[0] == state.slave and modbus_rtu.verify_crc(response):
+            state.record(elapsed)
+            state.failures = 0
+            state.next_poll = 0.0
+            if state.callback is not None:
+                state.callback(state.slave, response)
+            return response
+
+        state.timeouts += 1
+        state.failures += 1
+        backoff = min(self.base_backoff * 2 ** (state.failures - 1), self.max_backoff)
+        state.next_poll = time.monotonic() + backoff
+        return None
+
+    def run_cycle(self):
+        """轮询一遍所有到期的从机（处于退避中的从机跳过）
+        :return: 本轮实际轮询的从机数
+        """
+        polled = 0
+        for state in self.slaves.values():
+            if state.next_poll > time.monotonic():
+                continue
+            self.poll_slave(state)
+            polled += 1
+        return polled
+
+    def run(self, duration=None, cycles=None, interval=0.0):
+        """连续轮询
+        :param duration: 运行时间（秒）
+        :param cycles: 轮询轮数
+        :param interval: 两轮之间的间隔（秒）
+        """
+        if not self.slaves:
+            return
+        end = None if duration is None else time.monotonic() + duration
+        count = 0
+        while (end is None or time.monotonic() < end) and (cycles is None or count < cycles):
+            if not self.run_cycle():
+                # 所有从机都在退避中，等到最早的一个到期
+                wait = min(state.next_poll for state in self.slaves.values()) - time.monotonic()
+                if end is not None:
+                    wait = min(wait, end - time.monotonic())
+                time.sleep(max(wait, 0))
+            count += 1
+            if interval:
+                time.sleep(interval)
+
+    def report(self):
+        """各从机的轮询统计"""
+        return [state.report() for state in self.slaves.values()]
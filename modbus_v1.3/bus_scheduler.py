@@ -0,0 +1,251 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+import instrumentation
+import modbus_rtu
+
+# 优先级，数值越小越先执行
+PRIORITY_STOP = 0    # 安全/停止指令
+PRIORITY_NORMAL = 1  # 普通读写
+PRIORITY_POLL = 2    # 周期轮询
+
+
+class PeriodicJob:
+    """按固定周期执行的轮询任务"""
+
+    def __init__(self, command, period, callback, priority):
+        self.command = bytes(command)
+        self.period = period
+        self.callback = callback
+        self.priority = priority
+        self.next_time = time.monotonic()
+        self.cancelled = False
+        self.runs = 0
+        self.missed = 0  # 因总线繁忙而跳过的周期数
+        self.pending = None  # 已入队尚未完成的Future
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class BusChannel:
+    """以固定优先级通过调度器访问总线的串口替身
+    可直接传给使用modbus_rtu.transact的驱动，例如：
+        zs.ZSController(scheduler.channel(PRIORITY_POLL))
+    驱动通过modbus_rtu.transact_stop发送的停止指令不论替身的优先级都以PRIORITY_STOP执行
+    """
+
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.port = scheduler.ser.port
+        self.baudrate = scheduler.ser.baudrate
+        self.timeout = scheduler.ser.timeout
+
+    def scheduled_transact(self, command):
+        return self.scheduler.transact(command, self.priority)
+
+    def stop_transact(self, command):
+        return self.scheduler.stop_command(command)
+
+
+class BusScheduler:
+    """独占一个RS-485串口的总线调度器
+    所有事务由调度线程逐帧串行执行，帧间保证t3.5静默；
+    每完成一帧按优先级挑选下一帧，停止指令在当前帧结束后立即执行，
+    最坏等待时间为一帧事务时间（不超过串口timeout）加t3.5
+    """
+
+    def __init__(self, ser):
+        """
+        :param ser: 串口对象，交给调度器后其他代码不应再直接读写
+        """
+        self.ser = ser
+        self.gap = modbus_rtu.frame_gap(ser.baudrate)
+        self._queue = []
+        self._periodic = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self._last_end = 0.0
+        self._worker = threading.Thread(target=self._run, name=f"bus-{ser.port}", daemon=True)
+        self._worker.start()
+
+    def submit(self, command, priority=PRIORITY_NORMAL):
+        """提交一帧请求
+        :param command: 完整请求帧（含CRC）
+        :param priority: 优先级
+        :return: Future，结果为应答字节
+        """
+        future = Future()
+        future.enqueued_at = time.monotonic()
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("总线调度器已关闭")
+            heapq.heappush(self._queue, (priority, next(self._seq), bytes(command), future))
+            self._cond.notify()
+        return future
+
+    def transact(self, command, priority=PRIORITY_NORMAL, timeout=None):
+        """提交一帧请求并等待应答
+        :return: 应答字节
+        """
+        return self.submit(command, priority).result(timeout)
+
+    def stop_command(self, command):
+        """以最高优先级发送停止/安全指令并等待应答"""
+        return self.transact(command, PRIORITY_STOP)
+
+    def channel(self, priority=PRIORITY_NORMAL):
+        """获取以指定优先级访问总线的串口替身"""
+        return BusChannel(self, priority)
+
+    def add_periodic(self, command, period, callback=None, priority=PRIORITY_POLL):
+        """添加固定周期的轮询任务
+        :param command: 完整请求帧
+        :param period: 周期（秒）
+        :param callback: 每次收到应答后在调度线程中调用callback(response)，应尽量简短
+        :param priority: 优先级
+        :return: PeriodicJob，调用cancel()停止
+        """
+        job = PeriodicJob(command, period, callback, priority)
+        with self._cond:
+            heapq.heappush(self._periodic, (job.next_time, next(self._seq), job))
+            self._cond.notify()
+        return job
+
+    def close(self):
+        """停止调度线程，未执行的请求以异常结束"""
+        with self._cond:
+            self._running = False
+            pending, self._queue = self._queue, []
+            self._cond.notify()
+        for _, _, _, future in pending:
+            future.set_exception(RuntimeError("总线调度器已关闭"))
+        self._worker.join()
+
+    def _queue_due_jobs(self, now):
+        """把到期的周期任务放入队列，返回下一个周期任务的时间"""
+        while self._periodic:
+            next_time, _, job = self._periodic[0]
+            if job.cancelled:
+                heapq.heappop(self._periodic)
+                continue
+            if next_time > now:
+                return next_time
+            heapq.heappop(self._periodic)
+            if job.pending is not None and not job.pending.done():
+                # 上一周期的请求仍在排队（总线被更高优先级的事务占满），本周期跳过，不重复入队
+                job.missed += 1
+            else:
+                future = Future()
+                future.enqueued_at = next_time
+                future.add_done_callback(lambda f, job=job: self._periodic_done(job, f))
+                job.pending = future
+                heapq.heappush(self._queue, (job.priority, next(self._seq), job.command, future))
+            # 固定频率：按计划时间累加，落后太多时跳过错过的周期
+            job.next_time = next_time + job.period
+            if job.next_time <= now:
+                skipped = int((now - job.next_time) // job.period) + 1
+                job.missed += skipped
+                job.next_time += skipped * job.period
+            heapq.heappush(self._periodic, (job.next_time, next(self._seq), job))
+        return None
+
+    @staticmethod
+    def _periodic_done(job, future):
+        job.runs += 1
+        if job.callback is not None and future.exception() is None:
+            job.callback(future.result())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    next_periodic = self._queue_due_jobs(time.monotonic())
+                    if self._queue:
+                        break
+                    wait = None if next_periodic is None else max(next_periodic - time.monotonic(), 0)
+                    self._cond.wait(wait)
+                if not self._running:
+                    return
+                _, _, command, future = heapq.heappop(self._queue)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            # 与上一帧之间保持t3.5静默
+            delay = self._last_end + self.gap - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if instrumentation.enabled:
+                # 排队时间：入队（周期任务为计划时间）到开始发送
+                instrumentation.record_queue(f"{self.ser.port}/{command[0]}", command[1],
+                                             time.monotonic() - future.enqueued_at)
+            try:
+                response = modbus_rtu.transact(self.ser, command)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(response)
+            finally:
+                self._last_end = time.monotonic()
+
+
+class _LoopbackPort:
+    """自检用的串口替身：每帧耗时frame_time秒，原样回显0x06写单寄存器请求"""
+
+    def __init__(self, frame_time=0.005):
+        self.port = 'LOOPBACK'
+        self.baudrate = 115200
+        self.timeout = 0.1
+        self.frame_time = frame_time
+        self._buffer = b''
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def write(self, command):
+        time.sleep(self.frame_time)
+        self._buffer = bytes(command)
+        return len(command)
+
+    def read(self, size=1):
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def check_starved_bus(duration=1.0, period=0.01):
+    """自检：普通优先级事务占满总线期间，周期任务不积压重复请求，负载结束后不集中补发
+    :return: 是否通过
+    """
+    scheduler = BusScheduler(_LoopbackPort())
+    command = modbus_rtu.append_crc(bytearray([1, 0x06, 0, 0, 0, 1]))
+    job = scheduler.add_periodic(command, period)
+    end = time.monotonic() + duration
+    max_queued = 0
+    previous = scheduler.submit(command)
+    while time.monotonic() < end:
+        # 前台始终保持至少一帧普通优先级请求排队，周期任务得不到总线
+        future = scheduler.submit(command)
+        previous.result()
+        previous = future
+        with scheduler._cond:
+            max_queued = max(max_queued, sum(1 for entry in scheduler._queue if entry[0] == job.priority))
+    previous.result()
+    runs_after_load = job.runs
+    time.sleep(0.05)
+    burst = job.runs - runs_after_load
+    scheduler.close()
+    # 同一周期任务最多一帧在队列中；负载结束后0.05秒内按周期最多执行约5次
+    passed = max_queued <= 1 and burst <= 0.05 / period + 2
+    print(f"周期任务最多排队{max_queued}帧，跳过{job.missed}个周期，负载结束后0.05秒内执行{burst}次："
+          f"{'通过' if passed else '失败'}")
+    return passed
+
+
+if __name__ == "__main__":
+    check_starved_bus()
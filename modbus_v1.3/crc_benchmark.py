@@ -0,0 +1,56 @@
+import struct
+import timeit
+
+import modbus_rtu
+
+
+# 原逐位循环实现，仅作为对比基准
+def calculate_crc_bitwise(data):
+    crc_value = 0xFFFF
+    for byte in data:
+        crc_value ^= byte
+        for _ in range(8):
+            if crc_value & 0x0001:
+                crc_value = (crc_value >> 1) ^ 0xA001
+            else:
+                crc_value >>= 1
+    return struct.pack('<H', crc_value)
+
+
+def bench(name, func, number):
+    """运行并打印单项测试结果（每次调用耗时，单位us）"""
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    per_call = seconds / number * 1e6
+    print(f"{name:<40s} {per_call:8.2f} us")
+    return per_call
+
+
+if __name__ == "__main__":
+    # 典型帧：8字节读/写请求，以及一帧35段×7寄存器的写多寄存器帧
+    request = bytes.fromhex('01 06 21 05 00 01')
+    response = bytes.fromhex('01 03 02 00 64') + modbus_rtu.calculate_crc(bytes.fromhex('01 03 02 00 64'))
+    block = bytes(range(256)) * 2
+
+    # 校验两种实现结果一致
+    for sample in (request, response, block):
+        assert calculate_crc_bitwise(sample) == modbus_rtu.calculate_crc(sample)
+
+    number = 20000
+    print("=== CRC-16/Modbus 基准测试 ===")
+    old = bench("逐位循环 (6字节请求)", lambda: calculate_crc_bitwise(request), number)
+    new = bench("查表法 (6字节请求)", lambda: modbus_rtu.calculate_crc(request), number)
+    print(f"加速比: {old / new:.1f}x")
+
+    old = bench("逐位循环 (512字节块)", lambda: calculate_crc_bitwise(block), number // 50)
+    new = bench("查表法 (512字节块)", lambda: modbus_rtu.calculate_crc(block), number // 50)
+    print(f"加速比: {old / new:.1f}x")
+
+    # 原方式：切片后重新计算CRC再比较
+    bench("切片比较校验 (7字节响应)",
+          lambda: calculate_crc_bitwise(response[:-2]) == response[-2:], number)
+    bench("原地校验 verify_crc (7字节响应)",
+          lambda: modbus_rtu.verify_crc(response), number)
+
+    # 流式累加：分两段计算的结果应与整体计算一致
+    half = len(block) // 2
+    assert modbus_rtu.crc16(block[half:], modbus_rtu.crc16(block[:half])) == modbus_rtu.crc16(block)
@@ -0,0 +1,269 @@
+import json
+import struct
+
+import modbus_rtu
+
+# 设备描述：寄存器地址、宽度（寄存器个数）、符号、比例、范围及批量读取块都以数据形式给出，
+# 加载时编译为预先生成的struct.Struct编码器和连续块读取计划，新增设备型号只需增加一份描述。
+#
+# 寄存器字段：
+#   address   寄存器地址（JSON中可写为"0x040A"）
+#   width     占用寄存器个数，1或2，默认1
+#   signed    是否有符号，默认False
+#   scale     工程值 = 原始值 * scale，默认1
+#   min/max   原始值范围，写入时超出范围的值截断到范围内
+#   encoding  "int"（默认，二进制整数）或"decimal"（低位为万以内的余数，高位为万的倍数）
+#   word_order 双寄存器的字序，"high"（默认，高字在前）或"low"
+#   stride/count  按段重复的寄存器：第n段地址 = address + (n - 1) * stride，共count段
+#   unit/label    单位及说明，用于打印
+
+_VALUE_FORMATS = {
+    (1, False): 'H',
+    (1, True): 'h',
+    (2, False): 'I',
+    (2, True): 'i',
+}
+_WORDS = {1: struct.Struct('>H'), 2: struct.Struct('>HH')}
+_WRITE_SINGLE = struct.Struct('>BBHH')
+
+
+def _number(value):
+    """JSON中的地址可以写为十六进制字符串"""
+    return int(value, 0) if isinstance(value, str) else value
+
+
+class RegisterSpec:
+    """编译后的单个寄存器（或寄存器组）描述"""
+
+    def __init__(self, name, address, width=1, signed=False, scale=1, min=None, max=None,
+                 encoding='int', word_order='high', stride=0, count=1, unit='', label=None):
+        if width not in (1, 2):
+            raise ValueError(f"{name}: 寄存器宽度只能为1或2")
+        if encoding not in ('int', 'decimal'):
+            raise ValueError(f"{name}: 不支持的编码方式{encoding}")
+        if encoding == 'decimal' and width != 2:
+            raise ValueError(f"{name}: decimal编码需要2个寄存器")
+        self.name = name
+        self.address = _number(address)
+        self.width = width
+        self.signed = signed
+        self.scale = scale
+        bits = 16 * width
+        self.min = _number(min) if min is not None else (-(1 << bits - 1) if signed else 0)
+        self.max = _number(max) if max is not None else ((1 << bits - 1) - 1 if signed else (1 << bits) - 1)
+        self.encoding = encoding
+        self.low_first = word_order == 'low'
+        self.stride = _number(stride)
+        self.count = count
+        self.unit = unit
+        self.label = label or name
+        # 预先生成的编码器
+        self._value = struct.Struct('>' + _VALUE_FORMATS[width, signed])
+        self._words = _WORDS[width]
+        self._write_multiple = struct.Struct(f'>BBHHB{width}H')
+
+    def address_of(self, index=None):
+        """寄存器地址
+        :param index: 段号（从1开始），非分段寄存器忽略
+        """
+        if not self.stride or index is None:
+            return self.address
+        if not 1 <= index <= self.count:
+            raise ValueError(f"{self.label}: 段号必须在1-{self.count}范围内")
+        return self.address + (index - 1) * self.stride
+
+    def clamp(self, raw):
+        """把原始值截断到允许范围内"""
+        return min(max(int(raw), self.min), self.max)
+
+    def to_raw(self, value):
+        """工程值换算为原始值（已截断）"""
+        return self.clamp(round(value / self.scale) if self.scale != 1 else value)
+
+    def to_value(self, raw):
+        """原始值换算为工程值"""
+        return round(raw * self.scale, 10) if self.scale != 1 else raw
+
+    def encode_raw(self, raw):
+        """原始值编码为寄存器值元组（16位无符号）"""
+        raw = self.clamp(raw)
+        if self.encoding == 'decimal':
+            words = ((raw % 10000) & 0xFFFF, (raw // 10000) & 0xFFFF)
+            return words if self.low_first else words[::-1]
+        words = self._words.unpack(self._value.pack(raw))
+        return words[::-1] if self.low_first else words
+
+    def encode(self, value):
+        """工程值编码为寄存器值元组"""
+        return self.encode_raw(self.to_raw(value))
+
+    def decode_raw(self, words):
+        """寄存器值解码为原始值"""
+        words = tuple(words[:self.width])
+        if self.low_first:
+            words = words[::-1]
+        if self.encoding == 'decimal':
+            high, low = (w - 0x10000 if w & 0x8000 else w for w in words)
+            return high * 10000 + low
+        return self._value.unpack(self._words.pack(*words))[0]
+
+    def decode(self, words):
+        """寄存器值解码为工程值"""
+        return self.to_value(self.decode_raw(words))
+
+    def image(self, raw, index=None):
+        """生成{寄存器地址: 值}映像"""
+        address = self.address_of(index)
+        return dict(zip(range(address, address + self.width), self.encode_raw(raw)))
+
+    def raw_command(self, slave, raw, index=None):
+        """生成写入原始值的完整请求帧：单寄存器用0x06，双寄存器用0x10一帧写入"""
+        address = self.address_of(index)
+        words = self.encode_raw(raw)
+        if self.width == 1:
+            frame = bytearray(_WRITE_SINGLE.pack(slave, 0x06, address, words[0]))
+        else:
+            frame = bytearray(self._write_multiple.pack(slave, 0x10, address, self.width, self.width * 2, *words))
+        return modbus_rtu.append_crc(frame)
+
+    def command(self, slave, value, index=None):
+        """生成写入工程值的完整请求帧"""
+        return self.raw_command(slave, self.to_raw(value), index)
+
+    def describe(self, raw):
+        """格式化原始值，用于打印"""
+        return f"{self.to_value(raw):g}{self.unit}"
+
+
+class DeviceProfile:
+    """编译后的设备描述"""
+
+    def __init__(self, name, registers, blocks=None, max_registers=modbus_rtu.MAX_READ_REGISTERS):
+        """
+        :param name: 型号名称
+        :param registers: {寄存器名: 字段字典}
+        :param blocks: 批量读取块[(起始地址, 数量), ...]，None时按寄存器地址自动合并连续区间
+        :param max_registers: 单帧最多读取的寄存器数
+        """
+        self.name = name
+        self.registers = {key: RegisterSpec(key, **fields) for key, fields in registers.items()}
+        if blocks is None:
+            image = dict.fromkeys(address for spec in self.registers.values()
+                                  for address in self._addresses(spec))
+            blocks = [(start, len(values)) for start, values in
+                      modbus_rtu.group_registers(image, max_registers)]
+        self.blocks = tuple((_number(start), _number(count)) for start, count in blocks)
+        # 连续块读取计划，超过单帧上限的块预先拆开
+        self.read_plan = tuple((start + offset, min(max_registers, count - offset))
+                               for start, count in self.blocks
+                               for offset in range(0, count, max_registers))
+        self._by_address = {}
+        for spec in self.registers.values():
+            for index in range(1, spec.count + 1):
+                self._by_address[spec.address_of(index if spec.stride else None)] = (spec, index)
+
+    @staticmethod
+    def _addresses(spec):
+        for index in range(1, spec.count + 1):
+            address = spec.address_of(index if spec.stride else None)
+            yield from range(address, address + spec.width)
+
+    def __getitem__(self, name):
+        return self.registers[name]
+
+    def __contains__(self, name):
+        return name in self.registers
+
+    def __repr__(self):
+        return f"DeviceProfile({self.name})"
+
+    def decode_block(self, start, values):
+        """解码一段连续寄存器
+        :return: {寄存器名: 工程值}，分段寄存器为{寄存器名: {段号: 工程值}}
+        """
+        result = {}
+        end = start + len(values)
+        for address in range(start, end):
+            entry = self._by_address.get(address)
+            if entry is None:
+                continue
+            spec, index = entry
+            if address + spec.width > end:
+                continue
+            value = spec.decode(values[address - start:address - start + spec.width])
+            if spec.stride:
+                result.setdefault(spec.name, {})[index] = value
+            else:
+                result[spec.name] = value
+        return result
+
+
+def compile_profile(definition):
+    """把设备描述字典编译为DeviceProfile"""
+    return DeviceProfile(definition['name'], definition['registers'], definition.get('blocks'),
+                         definition.get('max_registers', modbus_rtu.MAX_READ_REGISTERS))
+
+
+def load_profile(path):
+    """从JSON文件加载设备描述并注册"""
+    with open(path, encoding='utf-8') as f:
+        profile = compile_profile(json.load(f))
+    PROFILES[profile.name] = profile
+    return profile
+
+
+def get_profile(name):
+    """按型号名称获取已编译的设备描述"""
+    return PROFILES[name]
+
+
+DS5L2_DEFINITION = {
+    'name': 'DS5L2',
+    'registers': {
+        # 多段位置参数：第1段从P4-10(0x040A)开始，每段占7个寄存器
+        'position': {'address': 0x040A, 'width': 2, 'signed': True, 'encoding': 'decimal', 'word_order': 'low',
+                     'min': -327689999, 'max': 327689999, 'stride': 7, 'count': 35, 'label': '脉冲数'},
+        'speed': {'address': 0x040C, 'scale': 0.1, 'stride': 7, 'count': 35, 'unit': 'rpm', 'label': '速度'},
+        'acc_time': {'address': 0x040D, 'stride': 7, 'count': 35, 'unit': 'ms', 'label': '加速时间'},
+        'dec_time': {'address': 0x040E, 'stride': 7, 'count': 35, 'unit': 'ms', 'label': '减速时间'},
+        'aux': {'address': 0x040F, 'stride': 7, 'count': 35, 'label': '段内第6个寄存器'},
+        'adjust_time': {'address': 0x0410, 'stride': 7, 'count': 35, 'unit': 'ms', 'label': '调整时间'},
+        'valid_segments': {'address': 0x0404, 'max': 35, 'label': '有效段数'},      # P4-04
+        'start_segment': {'address': 0x0408, 'max': 35, 'label': '起始段号'},       # P4-08
+        'enable': {'address': 0x2105, 'max': 1, 'label': '使能'},                   # F1-05
+        'set_segment': {'address': 0x2209, 'max': 35, 'label': '通信设定段号'},     # F2-09
+        'clear_alarm': {'address': 0x2000, 'max': 1, 'label': '清除报警'},          # F0-00
+    },
+    # 可写寄存器的批量读取块（F0-00为动作指令，不回读）
+    'blocks': [(0x0404, 1), (0x0408, 1), (0x040A, 35 * 7), (0x2105, 1), (0x2209, 1)],
+}
+
+ZS_DEFINITION = {
+    'name': 'ZS',
+    'registers': {
+        # 地址为40xxx-40001
+        'status': {'address': 0, 'label': '运行状态'},                                   # 40001
+        'accel': {'address': 149, 'min': 1, 'max': 100, 'label': '加减速系数'},           # 40150
+        'freq': {'address': 150, 'min': 1, 'max': 30000, 'unit': 'Hz', 'label': '脉冲频率'},  # 40151
+        'mode': {'address': 151, 'label': '工作模式'},                                   # 40152
+        'control': {'address': 155, 'max': 2, 'label': '运行控制'},                      # 40156
+        'pulse': {'address': 156, 'width': 2, 'label': '脉冲数'},                        # 40157-40158
+    },
+}
+
+O2_DEFINITION = {
+    'name': 'O2',
+    'registers': {
+        'status': {'address': 0x0000, 'label': '设备工作状态'},
+        'concentration': {'address': 0x0001, 'label': '气体浓度'},
+        'gas_type': {'address': 0x0002, 'label': '气体类别'},
+        'unit': {'address': 0x0003, 'label': '测量单位'},
+        'decimal_places': {'address': 0x0004, 'label': '小数位数'},
+    },
+}
+
+DS5L2 = compile_profile(DS5L2_DEFINITION)
+ZS = compile_profile(ZS_DEFINITION)
+O2 = compile_profile(O2_DEFINITION)
+
+PROFILES = {profile.name: profile for profile in (DS5L2, ZS, O2)}
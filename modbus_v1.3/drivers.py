@@ -0,0 +1,86 @@
+import importlib
+import importlib.util
+import os
+import sys
+import threading
+
+# 设备驱动名 -> 模块文件
+# 485_*.py以数字开头，不能用import语句导入，统一在这里按文件加载
+DRIVER_MODULES = {
+    'ds5l2': '485_DS5L2.py',
+    'o2': '485_O2.py',
+    'zs': '485_ZS.py',
+    'io': 'modbus_IO.py',
+    'valve': 'modbus_valve.py',
+    'temp': 'modbus_temp.py',
+}
+
+_DRIVER_DIR = os.path.dirname(os.path.abspath(__file__))
+_loaded = {}
+_lock = threading.Lock()
+
+
+def module_name(filename):
+    """文件名对应的模块名，485_DS5L2.py -> _485_DS5L2"""
+    name = os.path.splitext(filename)[0]
+    return '_' + name if name[0].isdigit() else name
+
+
+def load(name):
+    """加载驱动模块（同一驱动只加载一次）
+    :param name: 驱动名，见DRIVER_MODULES
+    :return: 模块对象
+    """
+    module = _loaded.get(name)
+    if module is not None:
+        return module
+    with _lock:
+        module = _loaded.get(name)
+        if module is not None:
+            return module
+        filename = DRIVER_MODULES[name]
+        mod_name = module_name(filename)
+        module = sys.modules.get(mod_name)
+        if module is None:
+            if mod_name == os.path.splitext(filename)[0]:
+                module = importlib.import_module(mod_name)
+            else:
+                spec = importlib.util.spec_from_file_location(mod_name, os.path.join(_DRIVER_DIR, filename))
+                module = importlib.util.module_from_spec(spec)
+                sys.modules[mod_name] = module
+                try:
+                    spec.loader.exec_module(module)
+                except BaseException:
+                    del sys.modules[mod_name]
+                    raise
+        _loaded[name] = module
+    return module
+
+
+def is_loaded(name):
+    """驱动是否已经加载"""
+    return name in _loaded
+
+
+class LazyDriver:
+    """驱动模块的延迟加载代理
+    第一次访问属性（即第一次使用设备）时才加载模块，
+    未用到的驱动及其依赖（pyserial、numpy等）不会被导入
+    """
+
+    def __init__(self, name):
+        if name not in DRIVER_MODULES:
+            raise KeyError(f"未知的驱动: {name}")
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(load(self._name), attr)
+
+    def __repr__(self):
+        state = "已加载" if is_loaded(self._name) else "未加载"
+        return f"<驱动 {self._name}（{state}）>"
+
+
+def lazy(name):
+    """获取驱动的延迟加载代理"""
+    return LazyDriver(name)
@@ -0,0 +1,392 @@
+import collections
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+
+import modbus_log
+import modbus_rtu
+import modbus_tcp
+
+logger = logging.getLogger(__name__)
+
+# 抓包文件格式（小端）：
+#   文件头  MAGIC
+#   记录    RECORD_HEADER（单调时钟纳秒, 端口号, 类型, 数据长度） + 数据
+# 类型：
+#   KIND_TX/KIND_RX  发送/接收的原始帧（RTU帧含CRC，TCP帧含MBAP头）
+#   KIND_PORT        端口号定义，数据为端口名称（UTF-8），在该端口的第一帧之前写入
+#   KIND_SESSION     一次抓包的开始，数据为墙上时钟纳秒；之后端口号重新定义，单调时钟与之前的记录不可比
+# 只追加写入，同一文件可多次打开续写；写入中断时末尾的不完整记录在读取时忽略
+MAGIC = b'MBCAP\x00\x01\x00'
+RECORD_HEADER = struct.Struct('<qHBH')
+KIND_TX = 0
+KIND_RX = 1
+KIND_PORT = 2
+KIND_SESSION = 3
+_KINDS = {'tx': KIND_TX, 'rx': KIND_RX}
+DIRECTIONS = ('tx', 'rx')
+_WALL_CLOCK = struct.Struct('<q')
+
+# 抓取到的一帧，data为指向映射文件的memoryview（不复制，读取器关闭后失效）
+CapturedFrame = collections.namedtuple('CapturedFrame', 'timestamp port direction data session')
+
+
+class CaptureWriter:
+    """追加写入抓包文件
+    轮询线程只把打包好的记录放入内存列表；后台线程每flush_interval秒（或积压超过max_pending字节时）
+    批量写入文件并fsync，异常退出或断电时最多丢失约flush_interval秒的帧。
+    出现ERROR日志时modbus_log.FrameDumpHandler调用request_flush()唤醒后台线程提前写入
+    """
+
+    def __init__(self, path, flush_interval=1.0, max_pending=1 << 22):
+        """
+        :param path: 抓包文件，已存在时在末尾续写
+        :param flush_interval: 写入文件的间隔（秒）
+        :param max_pending: 积压超过该字节数时提前写入
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        else:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    self._file.close()
+                    raise ValueError(f"{path} 不是抓包文件")
+        self._ports = {}
+        self._chunks = []
+        self._pending = 0
+        self._closed = False
+        self._lock = threading.Lock()     # 保护_chunks，轮询线程只持有很短时间
+        self._io_lock = threading.Lock()  # 保护文件写入，保证批次按顺序落盘
+        self._wakeup = threading.Event()
+        self.frames = 0
+        self._chunks.append(RECORD_HEADER.pack(time.monotonic_ns(), 0, KIND_SESSION, _WALL_CLOCK.size)
+                            + _WALL_CLOCK.pack(time.time_ns()))
+        self._thread = threading.Thread(target=self._run, name='frame-capture', daemon=True)
+        self._thread.start()
+
+    def write(self, port, direction, frame):
+        """写入一帧（只放入内存，由后台线程写文件）
+        :param port: 串口号或"IP:端口"
+        :param direction: 'tx'发送，'rx'接收
+        :param frame: 帧字节
+        """
+        timestamp = time.monotonic_ns()
+        with self._lock:
+            if self._closed:
+                return
+            port_id = self._ports.get(port)
+            if port_id is None:
+                port_id = self._ports[port] = len(self._ports)
+                name = str(port).encode('utf-8')
+                self._chunks.append(RECORD_HEADER.pack(timestamp, port_id, KIND_PORT, len(name)) + name)
+            record = RECORD_HEADER.pack(timestamp, port_id, _KINDS[direction], len(frame)) + frame
+            self._chunks.append(record)
+            self._pending += len(record)
+            self.frames += 1
+            if self._pending >= self.max_pending:
+                self._wakeup.set()
+
+    def flush(self):
+        """把积压的记录写入文件并fsync"""
+        with self._io_lock:
+            with self._lock:
+                chunks, self._chunks = self._chunks, []
+                self._pending = 0
+            if self._file is None or not chunks:
+                return
+            self._file.write(b''.join(chunks))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def request_flush(self):
+        """唤醒后台线程尽快写入文件，不等待写入完成"""
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                # 用WARNING，避免触发FrameDumpHandler再次请求写入
+                logger.warning("写入抓包文件%s失败: %s", self.path, e)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        with self._io_lock:
+            self._file.close()
+            self._file = None
+
+
+def start_capture(path, flush_interval=1.0):
+    """开始抓包：串口和TCP传输收发的每一帧都写入path
+    :param flush_interval: 写入文件的间隔（秒）
+    :return: CaptureWriter
+    """
+    stop_capture()
+    writer = CaptureWriter(path, flush_interval)
+    modbus_log.capture = writer
+    return writer
+
+
+def stop_capture():
+    """停止抓包，写入剩余的帧并关闭文件"""
+    writer, modbus_log.capture = modbus_log.capture, None
+    if writer is not None:
+        writer.close()
+
+
+class CaptureReader:
+    """以内存映射方式读取抓包文件，逐帧迭代，帧数据不复制
+    用法：
+        with CaptureReader('soak.mbcap') as reader:
+            for frame in reader:
+                ...
+    帧数据（memoryview）在读取器关闭后失效，需要保留时用bytes(frame.data)复制
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = None
+        self._view = memoryview(b'')
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            return
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} 不是抓包文件")
+        self._view = memoryview(self._map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.frames()
+
+    def frames(self, ports=None):
+        """逐帧迭代
+        :param ports: 只返回这些端口的帧，None表示全部
+        :return: CapturedFrame迭代器
+        """
+        view = self._view
+        unpack = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        end = len(view)
+        offset = len(MAGIC)
+        names = {}
+        session = 0
+        while offset + header_size <= end:
+            timestamp, port_id, kind, length = unpack(view, offset)
+            offset += header_size
+            if offset + length > end:
+                # 写入中断留下的不完整记录
+                break
+            if kind <= KIND_RX:
+                port = names.get(port_id)
+                if ports is None or port in ports:
+                    yield CapturedFrame(timestamp, port, DIRECTIONS[kind], view[offset:offset + length], session)
+            elif kind == KIND_PORT:
+                names[port_id] = str(view[offset:offset + length], 'utf-8')
+            elif kind == KIND_SESSION:
+                session += 1
+                names = {}
+            offset += length
+
+    def close(self):
+        self._view.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # 仍有帧数据被引用，映射在这些引用释放后自动关闭
+                pass
+            self._map = None
+        self._file.close()
+
+
+class SerialLink:
+    """回放目标：串口（或串口模拟器），按RTU帧边界收发"""
+
+    def __init__(self, ser):
+        self.ser = ser
+
+    def __call__(self, request):
+        return modbus_rtu.transact(self.ser, request)
+
+    def close(self):
+        self.ser.close()
+
+
+class TcpLink:
+    """回放目标：Modbus TCP服务器（或模拟器），原样发送抓取的ADU"""
+
+    def __init__(self, host, port=502, timeout=3.0):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _recv_exact(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("连接被对端关闭")
+            data += chunk
+        return data
+
+    def __call__(self, request):
+        self.sock.sendall(request)
+        try:
+            header = self._recv_exact(modbus_tcp.MBAP_HEADER.size)
+        except socket.timeout:
+            return b''
+        length = modbus_tcp.MBAP_HEADER.unpack(header)[2]
+        return bytes(header + self._recv_exact(length - 1))
+
+    def close(self):
+        self.sock.close()
+
+
+def _pair_key(port, frame):
+    """请求与应答的配对键：TCP（端口名为"IP:端口"）按事务标识符，串口上同一时刻只有一个请求"""
+    if port is not None and ':' in port:
+        return port, bytes(frame[:2])
+    return port, None
+
+
+def replay(path, link, speed=1.0, ports=None, max_mismatches=100):
+    """把抓取的请求重新发送到模拟器（或设备），并与抓取的应答比较
+    :param path: 抓包文件
+    :param link: 回放目标，可调用对象（请求帧 -> 应答帧，如SerialLink、TcpLink），
+                 或{抓取的端口名: 回放目标}，不在字典中的端口跳过
+    :param speed: 回放速度倍数，1为按原始间隔，10为加速10倍，None或0为不等待
+    :param ports: 只回放这些端口，None表示全部
+    :param max_mismatches: 报告中最多列出的不一致条数
+    :return: 回放报告
+    """
+    if isinstance(link, dict):
+        links = link
+        if ports is None:
+            ports = set(links)
+    else:
+        links = None
+    report = {'requests': 0, 'matched': 0, 'mismatched': 0, 'no_response': 0, 'mismatches': []}
+    pending = {}  # 配对键 -> (请求序号, 端口, 请求, 回放得到的应答)
+
+    def compare(entry, expected):
+        index, port, request, actual = entry
+        if actual == expected:
+            report['matched'] += 1
+            return
+        if not actual:
+            report['no_response'] += 1
+        else:
+            report['mismatched'] += 1
+        if len(report['mismatches']) < max_mismatches:
+            report['mismatches'].append({'index': index, 'port': port, 'request': request.hex(),
+                                         'expected': expected.hex(), 'actual': actual.hex()})
+
+    with CaptureReader(path) as reader:
+        session = None
+        origin = start = 0
+        for frame in reader.frames(ports):
+            key = _pair_key(frame.port, frame.data)
+            if frame.direction == 'rx':
+                entry = pending.pop(key, None)
+                if entry is not None:
+                    compare(entry, bytes(frame.data))
+                continue
+
+            target = links.get(frame.port) if links is not None else link
+            if target is None:
+                continue
+            if speed:
+                if frame.session != session:
+                    # 新的抓包段，单调时钟重新计起
+                    session = frame.session
+                    origin, start = frame.timestamp, time.monotonic_ns()
+                delay = (start + (frame.timestamp - origin) / speed - time.monotonic_ns()) / 1e9
+                if delay > 0:
+                    time.sleep(delay)
+            request = bytes(frame.data)
+            previous = pending.pop(key, None)
+            if previous is not None:
+                # 抓取时该请求没有应答
+                compare(previous, b'')
+            pending[key] = (report['requests'], frame.port, request, target(request))
+            report['requests'] += 1
+
+    for entry in pending.values():
+        compare(entry, b'')
+    return report
+
+
+def dump(path, ports=None, limit=None):
+    """打印抓包文件中的帧
+    :param limit: 最多打印的帧数，None表示全部
+    """
+    with CaptureReader(path) as reader:
+        origin = None
+        for count, frame in enumerate(reader.frames(ports)):
+            if limit is not None and count >= limit:
+                break
+            if origin is None or frame.session != origin[0]:
+                origin = (frame.session, frame.timestamp)
+            print(f"{frame.session} {(frame.timestamp - origin[1]) / 1e9:12.6f} {frame.port} "
+                  f"{frame.direction} {modbus_log.HexFrame(frame.data)}")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Modbus抓包文件查看与回放")
+    parser.add_argument('path', help="抓包文件")
+    parser.add_argument('--port', action='append', help="只处理指定端口（可重复）")
+    parser.add_argument('--limit', type=int, help="最多打印的帧数")
+    parser.add_argument('--replay-serial', metavar='DEVICE', help="回放到串口（如模拟器的虚拟串口）")
+    parser.add_argument('--baudrate', type=int, default=9600)
+    parser.add_argument('--replay-tcp', metavar='HOST:PORT', help="回放到Modbus TCP服务器")
+    parser.add_argument('--speed', type=float, default=1.0, help="回放速度倍数，0为不等待")
+    args = parser.parse_args()
+    ports = set(args.port) if args.port else None
+
+    if not args.replay_serial and not args.replay_tcp:
+        dump(args.path, ports, args.limit)
+        return
+
+    if args.replay_serial:
+        import serial
+        link = SerialLink(serial.Serial(args.replay_serial, args.baudrate, timeout=1))
+    else:
+        host, _, port = args.replay_tcp.rpartition(':')
+        link = TcpLink(host, int(port))
+    try:
+        report = replay(args.path, link, args.speed, ports)
+    finally:
+        link.close()
+    for mismatch in report.pop('mismatches'):
+        print(mismatch)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
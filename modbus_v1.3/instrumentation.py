@@ -0,0 +1,299 @@
+import threading
+
+# 运行时开关，关闭后各驱动的事务只多一次属性判断
+enabled = False
+
+# 对数-线性直方图：每个2的幂区间再等分为SUB_BUCKETS/2（16）个子区间，相对误差约2/SUB_BUCKETS（1/16）
+SUB_BITS = 5
+SUB_BUCKETS = 1 << SUB_BITS
+_HALF = SUB_BUCKETS >> 1
+# 记录范围：0 ~ 2**32微秒（约71分钟），超出的样本计入最后一个桶
+MAX_BITS = 32
+BUCKET_COUNT = SUB_BUCKETS + (MAX_BITS - SUB_BITS + 1) * _HALF
+
+RESULT_OK = 'ok'
+RESULT_TIMEOUT = 'timeout'      # 无应答或应答不完整
+RESULT_CRC = 'crc'              # CRC校验失败
+RESULT_EXCEPTION = 'exception'  # 设备返回异常应答
+RESULT_ERROR = 'error'          # 通信过程中抛出异常
+
+
+def enable():
+    """打开事务统计"""
+    global enabled
+    enabled = True
+
+
+def disable():
+    """关闭事务统计（已有数据保留）"""
+    global enabled
+    enabled = False
+
+
+def _bucket(value):
+    """微秒值对应的桶序号"""
+    if value < SUB_BUCKETS:
+        return value if value > 0 else 0
+    # 右移后保留SUB_BITS位有效数字，序号 = 移位数 * _HALF + 有效数字
+    shift = value.bit_length() - SUB_BITS
+    index = (shift << SUB_BITS - 1) + (value >> shift)
+    return index if index < BUCKET_COUNT else BUCKET_COUNT - 1
+
+
+def _bucket_upper(index):
+    """桶的上界（微秒）"""
+    if index < SUB_BUCKETS:
+        return index
+    shift = (index - SUB_BUCKETS) // _HALF + 1
+    mantissa = (index - SUB_BUCKETS) % _HALF + _HALF
+    return ((mantissa + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """固定内存的对数-线性延迟直方图（微秒精度）
+    记录只做一次桶序号计算和计数累加（约0.4微秒），不加锁；
+    多线程同时记录同一直方图时极少数计数可能丢失，对统计结果影响可忽略
+    """
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        """记录一个样本
+        :param seconds: 耗时（秒）
+        """
+        value = int(seconds * 1000000)
+        # 热路径：桶序号计算与_bucket相同，内联以省去一次函数调用
+        if value < SUB_BUCKETS:
+            index = value if value > 0 else 0
+        else:
+            shift = value.bit_length() - SUB_BITS
+            index = (shift << SUB_BITS - 1) + (value >> shift)
+            if index >= BUCKET_COUNT:
+                index = BUCKET_COUNT - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """分位数
+        :param q: 0~100
+        :return: 耗时（秒），无样本时返回None
+        """
+        if not self.count:
+            return None
+        target = max(1, -(-self.count * q // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(_bucket_upper(index), self.max) / 1000000
+        return self.max / 1000000
+
+    def mean(self):
+        return self.total / self.count / 1000000 if self.count else None
+
+    def reset(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def summary(self):
+        """统计摘要，单位毫秒"""
+        def ms(value):
+            return None if value is None else round(value * 1000, 3)
+        return {
+            'count': self.count,
+            'mean_ms': ms(self.mean()),
+            'p50_ms': ms(self.percentile(50)),
+            'p99_ms': ms(self.percentile(99)),
+            'p999_ms': ms(self.percentile(99.9)),
+            'max_ms': ms(self.max / 1000000),
+        }
+
+
+class TransactionStats:
+    """一个设备、一个功能码的事务统计
+    queue      入队到开始发送（总线调度器排队、TCP发送窗口等待）
+    wire       开始发送到收到完整应答，即本事务占用总线的时间
+    first_byte 开始发送到收到应答首部
+    frame      收到应答首部到收到完整应答
+    """
+
+    __slots__ = ('device', 'function', 'queue', 'wire', 'first_byte', 'frame',
+                 'results', 'exception_codes', 'retries', 'bytes_out', 'bytes_in', 'busy')
+
+    def __init__(self, device, function):
+        self.device = device
+        self.function = function
+        self.queue = LatencyHistogram()
+        self.wire = LatencyHistogram()
+        self.first_byte = LatencyHistogram()
+        self.frame = LatencyHistogram()
+        self.results = dict.fromkeys((RESULT_OK, RESULT_TIMEOUT, RESULT_CRC, RESULT_EXCEPTION, RESULT_ERROR), 0)
+        self.exception_codes = {}
+        self.retries = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.busy = 0.0  # 累计事务时间（秒），含超时等待；TCP流水线的事务时间相互重叠，总线占用见BusActivity
+
+    def summary(self):
+        return {
+            'device': self.device,
+            'function': self.function,
+            'results': dict(self.results),
+            'exception_codes': dict(self.exception_codes),
+            'retries': self.retries,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'busy_s': round(self.busy, 6),
+            'queue': self.queue.summary(),
+            'wire': self.wire.summary(),
+            'first_byte': self.first_byte.summary(),
+            'frame': self.frame.summary(),
+        }
+
+
+# (设备, 功能码) -> TransactionStats
+_stats = {}
+
+
+def stats(device, function):
+    """获取（必要时创建）设备、功能码对应的统计"""
+    entry = _stats.get((device, function))
+    if entry is None:
+        entry = _stats.setdefault((device, function), TransactionStats(device, function))
+    return entry
+
+
+def all_stats():
+    """全部统计对象列表"""
+    return list(_stats.values())
+
+
+def record_transaction(device, function, start, header_time, end, result, bytes_out=0, bytes_in=0,
+                       exception_code=None):
+    """记录一次事务
+    每次事务最多记录三个直方图并更新计数，约2微秒（相对于毫秒级的总线事务可忽略）
+    :param device: 设备标识，如"COM12/1"、"192.168.3.7:502/1"
+    :param function: 功能码
+    :param start: 开始发送的时间（time.monotonic()）
+    :param header_time: 收到应答首部的时间，无应答时为None
+    :param end: 事务结束的时间
+    :param result: RESULT_*
+    :param exception_code: 异常应答的异常码
+    """
+    entry = stats(device, function)
+    entry.results[result] += 1
+    entry.bytes_out += bytes_out
+    entry.bytes_in += bytes_in
+    entry.busy += end - start
+    if exception_code is not None:
+        entry.exception_codes[exception_code] = entry.exception_codes.get(exception_code, 0) + 1
+    if result == RESULT_TIMEOUT or result == RESULT_ERROR:
+        return
+    entry.wire.record(end - start)
+    if header_time is not None:
+        entry.first_byte.record(header_time - start)
+        entry.frame.record(end - header_time)
+
+
+def record_queue(device, function, seconds):
+    """记录一次排队时间"""
+    stats(device, function).queue.record(seconds)
+
+
+def record_retry(device, function):
+    """记录一次重试"""
+    stats(device, function).retries += 1
+
+
+class BusActivity:
+    """一条总线（串口或TCP连接）上至少有一个事务在途的累计时间，即各事务时间的并集
+    RS-485上事务逐个进行，等于事务时间之和；TCP流水线时重叠的部分只计一次
+    """
+
+    __slots__ = ('state', '_lock')
+
+    def __init__(self):
+        # (在途事务数, 本次占用开始时间, 已结束的累计占用时间)，整体替换，读取时无需加锁
+        self.state = (0, 0.0, 0.0)
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        """当前在途事务数"""
+        return self.state[0]
+
+    def begin(self, now):
+        """一个事务开始（已发送请求）"""
+        with self._lock:
+            in_flight, since, busy = self.state
+            self.state = (in_flight + 1, now if in_flight == 0 else since, busy)
+
+    def end(self, now):
+        """一个事务结束（收到应答、超时放弃或出错）"""
+        with self._lock:
+            in_flight, since, busy = self.state
+            if in_flight == 0:
+                return
+            self.state = (in_flight - 1, since, busy + now - since if in_flight == 1 else busy)
+
+    def total(self, now):
+        """截至now的累计占用时间（秒），读取快照，不加锁"""
+        in_flight, since, busy = self.state
+        return busy + (now - since if in_flight else 0.0)
+
+
+# 总线（串口号或"IP:端口"） -> BusActivity
+buses = {}
+
+
+def bus_activity(bus):
+    """获取（必要时创建）总线的占用统计"""
+    activity = buses.get(bus)
+    if activity is None:
+        activity = buses.setdefault(bus, BusActivity())
+    return activity
+
+
+# 设备最新读数：(名称, ((标签, 值), ...)) -> 数值，供指标导出使用
+values = {}
+
+
+def set_value(name, value, **labels):
+    """记录设备的最新读数（如浓度、温度、运行状态）
+    :param name: 指标名称
+    :param value: 数值
+    :param labels: 标签，如device="COM12/1"
+    """
+    values[name, tuple(sorted(labels.items()))] = value
+
+
+def reset():
+    """清空全部统计"""
+    _stats.clear()
+    buses.clear()
+    values.clear()
+
+
+def snapshot():
+    """全部统计的摘要列表，按设备、功能码排序"""
+    return [entry.summary() for entry in sorted(all_stats(), key=lambda e: (e.device, e.function))]
+
+
+def report():
+    """打印各设备、功能码的延迟分位数"""
+    for entry in sorted(all_stats(), key=lambda e: (e.device, e.function)):
+        wire = entry.wire.summary()
+        print(f"{entry.device} 功能码{entry.function:#04x}: {entry.results} "
+              f"p50={wire['p50_ms']}ms p99={wire['p99_ms']}ms p999={wire['p999_ms']}ms")
+
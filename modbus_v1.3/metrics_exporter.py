@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+QUANTILES = (0.5, 0.99, 0.999)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class MetricsExporter:
+    """Prometheus格式的本地指标导出
+    在独立的守护线程中提供HTTP服务，抓取时直接读取instrumentation中的计数
+    （不加锁，轮询线程无需任何额外操作），所有格式化都在导出线程中进行
+    """
+
+    def __init__(self, host='127.0.0.1', port=9502):
+        """
+        :param host: 监听地址，默认只允许本机访问
+        :param port: 监听端口
+        """
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+        self._last_busy = {}  # 总线 -> (抓取时间, 累计占用时间)
+
+    def start(self):
+        """启动HTTP服务（守护线程）"""
+        if self._server is not None:
+            return
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # 不输出每次抓取的访问日志
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics-exporter', daemon=True)
+        self._thread.start()
+        logger.info("指标导出: http://%s:%s/metrics", self.host, self.port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _utilization(self, bus, busy, now):
+        """两次抓取之间总线被占用的百分比，首次抓取返回None"""
+        last = self._last_busy.get(bus)
+        self._last_busy[bus] = (now, busy)
+        if last is None or now <= last[0]:
+            return None
+        return min(100.0, max(0.0, (busy - last[1]) / (now - last[0]) * 100))
+
+    def render(self):
+        """生成Prometheus文本格式的全部指标"""
+        now = time.monotonic()
+        entries = instrumentation.all_stats()
+        lines = []
+
+        lines.append('# HELP modbus_transactions_total Modbus transactions by result (ok/timeout/crc/exception/error).')
+        lines.append('# TYPE modbus_transactions_total counter')
+        for entry in entries:
+            for result, count in list(entry.results.items()):
+                lines.append(f'modbus_transactions_total'
+                             f'{_labels(device=entry.device, function=entry.function, result=result)} {count}')
+
+        lines.append('# HELP modbus_exception_responses_total Exception responses by exception code.')
+        lines.append('# TYPE modbus_exception_responses_total counter')
+        for entry in entries:
+            for code, count in list(entry.exception_codes.items()):
+                lines.append(f'modbus_exception_responses_total'
+                             f'{_labels(device=entry.device, function=entry.function, code=code)} {count}')
+
+        lines.append('# HELP modbus_retries_total Retried transactions.')
+        lines.append('# TYPE modbus_retries_total counter')
+        for entry in entries:
+            lines.append(f'modbus_retries_total{_labels(device=entry.device, function=entry.function)} {entry.retries}')
+
+        lines.append('# HELP modbus_bytes_total Bytes on the wire.')
+        lines.append('# TYPE modbus_bytes_total counter')
+        for entry in entries:
+            lines.append(f'modbus_bytes_total'
+                         f'{_labels(device=entry.device, function=entry.function, direction="tx")} {entry.bytes_out}')
+            lines.append(f'modbus_bytes_total'
+                         f'{_labels(device=entry.device, function=entry.function, direction="rx")} {entry.bytes_in}')
+
+        lines.append('# HELP modbus_latency_seconds Request to complete response latency.')
+        lines.append('# TYPE modbus_latency_seconds summary')
+        for entry in entries:
+            wire = entry.wire
+            for quantile in QUANTILES:
+                value = wire.percentile(quantile * 100)
+                if value is not None:
+                    lines.append(f'modbus_latency_seconds'
+                                 f'{_labels(device=entry.device, function=entry.function, quantile=quantile)} {value}')
+            lines.append(f'modbus_latency_seconds_sum'
+                         f'{_labels(device=entry.device, function=entry.function)} {wire.total / 1000000}')
+            lines.append(f'modbus_latency_seconds_count'
+                         f'{_labels(device=entry.device, function=entry.function)} {wire.count}')
+
+        # 总线占用按在途时间的并集统计，TCP流水线中重叠的事务只计一次
+        buses = sorted(list(instrumentation.buses.items()), key=lambda item: str(item[0]))
+        busy = {bus: activity.total(now) for bus, activity in buses}
+        lines.append('# HELP modbus_bus_busy_seconds_total Time with at least one transaction in flight on the bus.')
+        lines.append('# TYPE modbus_bus_busy_seconds_total counter')
+        for bus, seconds in busy.items():
+            lines.append(f'modbus_bus_busy_seconds_total{_labels(bus=bus)} {seconds}')
+        lines.append('# HELP modbus_bus_utilization_percent Bus utilization since the previous scrape.')
+        lines.append('# TYPE modbus_bus_utilization_percent gauge')
+        for bus, seconds in busy.items():
+            utilization = self._utilization(bus, seconds, now)
+            if utilization is not None:
+                lines.append(f'modbus_bus_utilization_percent{_labels(bus=bus)} {utilization:.3f}')
+        lines.append('# HELP modbus_bus_in_flight Transactions currently in flight (TCP pipelining window usage).')
+        lines.append('# TYPE modbus_bus_in_flight gauge')
+        for bus, activity in buses:
+            lines.append(f'modbus_bus_in_flight{_labels(bus=bus)} {activity.in_flight}')
+
+        # 设备最新读数
+        declared = set()
+        readings = sorted(list(instrumentation.values.items()), key=lambda item: (item[0][0], str(item[0][1])))
+        for (name, labels), value in readings:
+            metric = f'modbus_{name}'
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f'# TYPE {metric} gauge')
+            lines.append(f'{metric}{_labels(**dict(labels))} {value}')
+
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def start_exporter(host='127.0.0.1', port=9502):
+    """打开事务统计并启动指标导出
+    :return: MetricsExporter
+    """
+    instrumentation.enable()
+    exporter = MetricsExporter(host, port)
+    exporter.start()
+    return exporter
@@ -1,20 +1,11 @@
 import struct
-from pymodbus.client import ModbusTcpClient
 import logging
 
-# 启用调试日志
-logging.basicConfig(level=logging.DEBUG)
+import modbus_log
+import modbus_tcp
 
-# 设置 Modbus TCP 客户端
-client = ModbusTcpClient('192.168.3.7', port=502)
+logger = logging.getLogger(__name__)
 
-# 连接到 Modbus 服务器
-if client.connect():
-    print("连接成功")
-else:
-    print("连接失败")
-    client.close()
-    exit()
 
 def send_modbus_command(client, unit_id=0x01, function_code=0x05, address=0x0000, data=0xFF00):
     """
@@ -28,7 +19,7 @@ def send_modbus_command(client, unit_id=0x01, function_code=0x05, address=0x0000
     """
     try:
         # 构建 Modbus TCP 数据包
-        tcp_header = struct.pack('>HHH', 0x0000, 0x0000, 0x06)  # 事务标识符、协议标识符、数据长度
+        tcp_header = struct.pack('>HHH', modbus_tcp.next_transaction_id(), 0x0000, 0x06)  # 事务标识符、协议标识符、数据长度
         modbus_data = struct.pack('>B B H H', unit_id, function_code, address, data)  # 单元ID、功能码、地址、数据
         
         # 合并 TCP 头部和 Modbus 数据部分
@@ -39,18 +30,108 @@ def send_modbus_command(client, unit_id=0x01, function_code=0x05, address=0x0000
         
         # 打印响应（如果有的话）
         if response:
-            print(f"发送指令成功，功能码：{hex(function_code)}，地址：{hex(address)}，数据：{hex(data)}")
-            print("收到响应:", response)
+            logger.info("发送指令成功，功能码：%#x，地址：%#x，数据：%#x", function_code, address, data)
+            logger.debug("收到响应: %s", response)
             return True
         else:
-            print(f"发送指令失败，功能码：{hex(function_code)}，地址：{hex(address)}，数据：{hex(data)}")
+            logger.error("发送指令失败，功能码：%#x，地址：%#x，数据：%#x", function_code, address, data)
             return False
     except Exception as e:
-        print(f"发送Modbus指令时发生错误: {e}")
+        logger.error("发送Modbus指令时发生错误: %s", e)
         return False
 
-# 发送Modbus指令
-send_modbus_command(client, unit_id=0x01, function_code=0x05, address=0x0000, data=0xFF00)
+class IOModule:
+    """远程IO模块，带线圈状态缓存
+    写入时只发送变化的线圈：找出变化的连续区间，每个区间用一帧0x0F写入；
+    区间之间的线圈状态已知时合并为一帧，使同一步的多个输出同时动作
+    """
+
+    def __init__(self, transport, unit_id=0x01, coil_count=8, base_address=0x0000):
+        """
+        :param transport: modbus_tcp.ModbusTcpTransport
+        :param unit_id: 单元标识符
+        :param coil_count: 线圈数量
+        :param base_address: 第一个线圈的地址
+        """
+        self.transport = transport
+        self.unit_id = unit_id
+        self.coil_count = coil_count
+        self.base_address = base_address
+        self.coils = [None] * coil_count  # 缓存的线圈状态，None表示未知
+
+    def refresh(self):
+        """用一帧0x01批量读取全部线圈，刷新缓存
+        :return: 线圈状态列表
+        """
+        pdu = self.transport.request(self.unit_id, modbus_tcp.read_coils_pdu(self.base_address, self.coil_count))
+        modbus_tcp.check_response(pdu, 0x01)
+        self.coils = modbus_tcp.unpack_coils(pdu[2:], self.coil_count)
+        return list(self.coils)
+
+    def set_many(self, states):
+        """设置多个线圈
+        :param states: {线圈序号(0起): 状态}
+        :return: 发送的帧数
+        """
+        target = list(self.coils)
+        for index, state in states.items():
+            if not 0 <= index < self.coil_count:
+                raise ValueError(f"线圈序号超出范围: {index}")
+            target[index] = bool(state)
+        # 未指定且状态未知的线圈保持None，不会被写入
+        ranges = modbus_tcp.changed_ranges(self.coils, target)
+
+        for start, end in ranges:
+            address = self.base_address + start
+            values = target[start:end]
+            try:
+                pdu = self.transport.request(self.unit_id, modbus_tcp.write_coils_pdu(address, values))
+                modbus_tcp.check_write_coils_response(pdu, address, end - start)
+            except Exception:
+                # 超时、断线或应答不符时设备可能已经执行了写入，相应线圈状态置为未知
+                self.coils[start:end] = [None] * (end - start)
+                raise
+            self.coils[start:end] = [bool(v) for v in values]
+        return len(ranges)
+
+    def apply(self, mask):
+        """按位掩码设置全部线圈，第0位对应第1个线圈
+        :return: 发送的帧数
+        """
+        return self.set_many({index: mask >> index & 1 for index in range(self.coil_count)})
+
+    def mask(self):
+        """当前缓存的线圈状态位掩码（未知状态按关闭计）"""
+        return sum(1 << index for index, state in enumerate(self.coils) if state)
+
+
+def main(host='192.168.3.7', port=502):
+    """连接设备并发送Modbus指令（导入本模块时不做任何通信）"""
+    # pymodbus只在直接运行本脚本时需要
+    from pymodbus.client import ModbusTcpClient
+
+    # 启用调试日志
+    modbus_log.setup_logging(level=logging.DEBUG)
+
+    # 设置 Modbus TCP 客户端
+    client = ModbusTcpClient(host, port=port)
+
+    # 连接到 Modbus 服务器
+    if client.connect():
+        logger.info("连接成功")
+    else:
+        logger.error("连接失败")
+        client.close()
+        modbus_log.stop_logging()
+        return
+
+    # 发送Modbus指令
+    send_modbus_command(client, unit_id=0x01, function_code=0x05, address=0x0000, data=0xFF00)
+
+    # 关闭连接
+    client.close()
+    modbus_log.stop_logging()
+
 
-# 关闭连接
-client.close()
+if __name__ == "__main__":
+    main()
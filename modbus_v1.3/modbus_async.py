@@ -0,0 +1,301 @@
+import asyncio
+import functools
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+import modbus_log
+import modbus_rtu
+import modbus_tcp
+
+
+class AsyncSerialPort:
+    """asyncio下的RS-485串口传输
+    每个串口一个专用线程独占串口对象，所有请求在该线程上依次执行，
+    保证同一总线上的帧不会交错；不同串口互不阻塞
+    """
+
+    def __init__(self, ser, timeout=None):
+        """
+        :param ser: 串口对象
+        :param timeout: 默认单次请求截止时间（秒），None时为串口timeout加1秒
+        """
+        self.ser = ser
+        self.timeout = timeout if timeout is not None else (ser.timeout or 1) + 1
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"rtu-{ser.port}")
+
+    async def call(self, func, *args, timeout=None, **kwargs):
+        """在串口线程上执行同步函数（如现有驱动的操作）
+        :param timeout: 截止时间（秒），None表示不限制
+        超时后协程立即返回TimeoutError，已开始的串口操作仍会在线程中执行完毕
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        if timeout is None:
+            return await future
+        return await asyncio.wait_for(future, timeout)
+
+    async def request(self, command, timeout=None):
+        """发送一帧RTU请求并等待应答
+        :param command: 完整请求帧（含CRC）
+        :param timeout: 截止时间（秒），默认使用端口的timeout
+        :return: 应答字节
+        """
+        return await self.call(modbus_rtu.transact, self.ser, command,
+                               timeout=self.timeout if timeout is None else timeout)
+
+    async def read_registers(self, address, register_address, count, function=0x03, timeout=None):
+        """读寄存器
+        :return: 寄存器值元组，应答无效时返回None
+        """
+        command = modbus_rtu.build_read_command(address, function, register_address, count)
+        return modbus_rtu.parse_registers(await self.request(command, timeout))
+
+    async def write_registers(self, address, register_address, values, timeout=None):
+        """用0x10写入连续寄存器
+        :return: 写入是否成功
+        """
+        command = modbus_rtu.build_write_registers_command(address, register_address, values)
+        response = await self.request(command, timeout)
+        return modbus_rtu.check_write_response(response, address, 0x10, register_address, len(values))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class AsyncTcpTransport:
+    """asyncio原生的Modbus TCP传输
+    递增事务标识符，同一连接上最多window个请求在途，按事务标识符匹配应答
+    """
+
+    def __init__(self, host, port=502, window=4, timeout=3.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._window = asyncio.Semaphore(window)
+        self._pending = {}
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._connect_lock = asyncio.Lock()
+        self._name = f"{host}:{port}"
+
+    def __repr__(self):
+        return f"AsyncTcpTransport({self.host}:{self.port})"
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+            self._reader_task = asyncio.create_task(self._read_loop(self._reader))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                header = await reader.readexactly(modbus_tcp.MBAP_HEADER.size)
+                transaction_id, _, length, _ = modbus_tcp.MBAP_HEADER.unpack(header)
+                pdu = await reader.readexactly(length - 1)
+                modbus_log.record_frame(self._name, 'rx', header + pdu)
+                future = self._pending.pop(transaction_id, None)
+                if future is not None and not future.done():
+                    future.set_result(pdu)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            error = ConnectionError(f"接收失败: {e}")
+        except asyncio.CancelledError:
+            error = ConnectionError("连接已关闭")
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def request(self, unit_id, pdu, timeout=None):
+        """发送请求并等待应答
+        :param timeout: 截止时间（秒），默认使用连接的timeout
+        :return: (应答PDU, 延迟秒数)
+        """
+        await self.connect()
+        async with self._window:
+            transaction_id = modbus_tcp.next_transaction_id()
+            future = asyncio.get_running_loop().create_future()
+            self._pending[transaction_id] = future
+            adu = modbus_tcp.build_adu(transaction_id, unit_id, pdu)
+            sent_at = time.monotonic()
+            activity = instrumentation.bus_activity(self._name) if instrumentation.enabled else None
+            if activity is not None:
+                activity.begin(sent_at)
+            try:
+                # 接收任务在connect()之后断开时_writer已被置为None
+                writer = self._writer
+                if writer is None:
+                    raise ConnectionError(f"{self._name} 连接已断开")
+                modbus_log.record_frame(self._name, 'tx', adu)
+                writer.write(adu)
+                # 发送缓冲区过满时等待，连接断开时在这里抛出异常
+                await writer.drain()
+                response = await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+            except asyncio.TimeoutError:
+                if instrumentation.enabled:
+                    instrumentation.record_transaction(f"{self.host}:{self.port}/{unit_id}", pdu[0], sent_at, None,
+                                                       time.monotonic(), instrumentation.RESULT_TIMEOUT)
+                raise
+            except ConnectionError:
+                raise
+            except OSError as e:
+                raise ConnectionError(f"发送失败: {e}") from e
+            finally:
+                self._pending.pop(transaction_id, None)
+                if activity is not None:
+                    activity.end(time.monotonic())
+            end = time.monotonic()
+            if instrumentation.enabled:
+                exception = bool(response) and response[0] & 0x80
+                instrumentation.record_transaction(
+                    f"{self.host}:{self.port}/{unit_id}", pdu[0], sent_at, None, end,
+                    instrumentation.RESULT_EXCEPTION if exception else instrumentation.RESULT_OK,
+                    modbus_tcp.MBAP_HEADER.size + len(pdu), modbus_tcp.MBAP_HEADER.size + len(response),
+                    response[1] if exception and len(response) > 1 else None)
+            return response, end - sent_at
+
+    async def read_registers(self, unit_id, register_address, count, function=0x04, timeout=None):
+        """读寄存器
+        :return: 寄存器值元组
+        """
+        pdu, _ = await self.request(unit_id, struct.pack('>BHH', function, register_address, count), timeout)
+        modbus_tcp.check_response(pdu, function)
+        return struct.unpack_from(f'>{pdu[1] // 2}H', pdu, 2)
+
+    async def write_coils(self, unit_id, address, states, timeout=None):
+        """用0x0F写多个线圈，并校验应答回显"""
+        pdu, _ = await self.request(unit_id, modbus_tcp.write_coils_pdu(address, states), timeout)
+        modbus_tcp.check_write_coils_response(pdu, address, len(states))
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class BlockingTcpClient:
+    """AsyncTcpTransport的同步接口，供IOModule、ValveIsland等同步驱动使用
+    驱动在线程池中执行，请求提交到事件循环，由AsyncTcpTransport发送并按事务标识符匹配应答：
+        io = engine.driver(modbus_IO.IOModule(engine.tcp_client('192.168.3.7')))
+        await io.apply(0b101)
+    """
+
+    def __init__(self, transport, loop):
+        self.transport = transport
+        self.host = transport.host
+        self.port = transport.port
+        self._loop = loop
+
+    def __repr__(self):
+        return f"BlockingTcpClient({self.host}:{self.port})"
+
+    def request(self, unit_id, pdu, timeout=None):
+        """发送请求并等待应答（不能在事件循环线程中调用）
+        :return: 应答PDU
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            raise RuntimeError("不能在事件循环线程中同步等待，请使用AsyncTcpTransport.request")
+        future = asyncio.run_coroutine_threadsafe(self.transport.request(unit_id, pdu, timeout), self._loop)
+        return future.result()[0]
+
+    def is_open(self):
+        return self.transport._writer is not None
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.transport.close(), self._loop).result()
+
+
+class AsyncDriver:
+    """把现有的同步驱动对象包装为协程接口
+    驱动的方法在其所在总线的线程上执行，例如：
+        zs_motor = engine.driver(zs.ZSController(ser), ser)
+        await zs_motor.move(direction=1, freq=1000, pulses=500, accel=50)
+    """
+
+    def __init__(self, driver, runner):
+        self._driver = driver
+        self._runner = runner
+
+    def __getattr__(self, name):
+        method = getattr(self._driver, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, timeout=None, **kwargs):
+            return await self._runner(method, *args, timeout=timeout, **kwargs)
+        return call
+
+
+class ModbusEngine:
+    """asyncio Modbus引擎：每个RS-485串口一个串口传输，每个TCP主机一个TCP传输
+    各总线相互独立，可在同一事件循环中同时驱动
+    """
+
+    def __init__(self, tcp_workers=4):
+        self._serial_ports = {}
+        self._tcp_transports = {}
+        # 同步的TCP驱动（IOModule、ValveIsland等）在此线程池中执行，
+        # 驱动使用tcp_client()作为transport时请求经由AsyncTcpTransport发送
+        self._tcp_executor = ThreadPoolExecutor(max_workers=tcp_workers, thread_name_prefix="tcp-driver")
+
+    def serial(self, ser):
+        """获取串口对应的传输（同一串口只创建一次）"""
+        port = self._serial_ports.get(ser.port)
+        if port is None:
+            port = self._serial_ports[ser.port] = AsyncSerialPort(ser)
+        return port
+
+    def tcp(self, host, port=502):
+        """获取TCP主机对应的传输（同一主机只创建一次）"""
+        key = (host, port)
+        transport = self._tcp_transports.get(key)
+        if transport is None:
+            transport = self._tcp_transports[key] = AsyncTcpTransport(host, port)
+        return transport
+
+    def tcp_client(self, host, port=502):
+        """获取TCP主机的同步客户端，作为IOModule、ValveIsland等同步驱动的transport
+        （需在事件循环中调用），驱动的请求都经由该主机的AsyncTcpTransport发送
+        :return: BlockingTcpClient
+        """
+        return BlockingTcpClient(self.tcp(host, port), asyncio.get_running_loop())
+
+    async def _run_tcp_driver(self, func, *args, timeout=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._tcp_executor, functools.partial(func, *args, **kwargs))
+        if timeout is None:
+            return await future
+        return await asyncio.wait_for(future, timeout)
+
+    def driver(self, driver, ser=None):
+        """把同步驱动包装为协程接口
+        :param driver: 驱动对象
+        :param ser: 驱动使用的串口；None表示TCP驱动
+        :return: AsyncDriver
+        """
+        if ser is not None:
+            return AsyncDriver(driver, self.serial(ser).call)
+        return AsyncDriver(driver, self._run_tcp_driver)
+
+    async def close(self):
+        for port in self._serial_ports.values():
+            port.close()
+        for transport in self._tcp_transports.values():
+            await transport.close()
+        self._tcp_executor.shutdown(wait=False)
+        self._serial_ports.clear()
+        self._tcp_transports.clear()
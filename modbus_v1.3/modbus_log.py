@@ -0,0 +1,189 @@
+import collections
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# 最近收发的原始帧：(时间, 端口, 方向, 帧字节)，出现错误日志时转储
+FRAME_RING_SIZE = 256
+frames = collections.deque(maxlen=FRAME_RING_SIZE)
+# 抓包写入器，由frame_capture.start_capture设置，None表示不抓包
+capture = None
+
+
+def record_frame(port, direction, frame):
+    """把原始帧放入环形缓冲区，抓包时同时写入抓包文件（热路径，串口和TCP传输收发的每一帧都经过这里）
+    :param port: 串口号或"IP:端口"
+    :param direction: 'tx'发送，'rx'接收
+    :param frame: 帧字节
+    """
+    frame = bytes(frame)
+    frames.append((time.monotonic(), port, direction, frame))
+    if capture is not None:
+        capture.write(port, direction, frame)
+
+
+class HexFrame:
+    """延迟格式化的帧，只有日志真正输出时才转换为十六进制文本
+    用法：logger.debug("发送: %s", HexFrame(command))
+    """
+
+    __slots__ = ('frame',)
+
+    def __init__(self, frame):
+        # 复制一份，避免输出前原bytearray被修改
+        self.frame = bytes(frame) if frame is not None else b''
+
+    def __str__(self):
+        return ' '.join(f'{byte:02X}' for byte in self.frame)
+
+
+class FrameDump:
+    """延迟格式化的环形缓冲区快照"""
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def __str__(self):
+        if not self.entries:
+            return "（无记录）"
+        end = self.entries[-1][0]
+        return '\n'.join(f"  {t - end:+.3f}s {port} {direction} {HexFrame(frame)}"
+                         for t, port, direction, frame in self.entries)
+
+
+def _arg_key(arg):
+    """参数在限流键中的表示，均不格式化参数：简单类型原样使用，HexFrame用帧字节，
+    FrameDump用帧数，异常用类型和参数，其他对象用类型和标识
+    """
+    if isinstance(arg, (int, float, str, bytes)):
+        return arg
+    if isinstance(arg, HexFrame):
+        return arg.frame
+    if isinstance(arg, FrameDump):
+        return FrameDump, len(arg.entries)
+    if isinstance(arg, BaseException):
+        return type(arg), tuple(_arg_key(a) for a in arg.args)
+    return type(arg), id(arg)
+
+
+class RateLimitFilter(logging.Filter):
+    """同一位置、同一内容的日志在interval秒内只输出一次
+    被抑制的条数在下一次输出时附在消息末尾；按调用位置、消息模板及参数判断是否相同。
+    DEBUG及以下的记录（逐帧跟踪）不限流，由日志级别控制
+    """
+
+    def __init__(self, interval=5.0, max_keys=1024):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        self._seen = {}  # 键 -> [上次输出时间, 抑制条数]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG:
+            return True
+        args = record.args if isinstance(record.args, tuple) else ()
+        key = (record.name, record.levelno, record.pathname, record.lineno, record.msg,
+               tuple(_arg_key(a) for a in args))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is not None and now - entry[0] < self.interval:
+                entry[1] += 1
+                return False
+            if len(self._seen) >= self.max_keys:
+                self._seen.clear()
+            suppressed = entry[1] if entry is not None else 0
+            self._seen[key] = [now, 0]
+        if suppressed:
+            record.msg = f"{record.msg}（{self.interval:g}s内重复{suppressed}次已省略）"
+        return True
+
+
+class FrameDumpHandler(logging.Handler):
+    """出现ERROR及以上的日志时，把环形缓冲区中的原始帧作为一条日志转储并清空缓冲区，
+    正在抓包时唤醒抓包后台线程提前写入磁盘（不在记录日志的线程中写文件）。
+    interval秒内最多转储一次，期间的帧留在缓冲区中随下一次转储输出
+    """
+
+    def __init__(self, ring=frames, level=logging.ERROR, interval=5.0):
+        super().__init__(level)
+        self.ring = ring
+        self.interval = interval
+        self._last_dump = None
+        self._dump_logger = logging.getLogger('modbus.frames')
+
+    def emit(self, record):
+        if record.name == self._dump_logger.name:
+            return
+        now = time.monotonic()
+        # emit在Handler的锁内调用，无需另外加锁
+        if self._last_dump is not None and now - self._last_dump < self.interval:
+            return
+        self._last_dump = now
+        if capture is not None:
+            capture.request_flush()
+        entries = list(self.ring)
+        if not entries:
+            return
+        self.ring.clear()
+        self._dump_logger.error("最近%d帧原始数据：\n%s", len(entries), FrameDump(entries))
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """不在调用线程中格式化消息，格式化留给后台线程"""
+
+    def prepare(self, record):
+        return record
+
+
+_listener = None
+
+
+def setup_logging(level=logging.INFO, log_file=None, console=True, rate_limit=5.0,
+                  fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s'):
+    """配置日志：调用线程只把记录放入队列，后台线程格式化并写文件/控制台
+    :param level: 日志级别
+    :param log_file: 日志文件，None表示不写文件
+    :param console: 是否输出到控制台
+    :param rate_limit: 相同日志的最短间隔（秒），None表示不限制
+    :return: QueueListener
+    """
+    global _listener
+    stop_logging()
+
+    formatter = logging.Formatter(fmt)
+    handlers = []
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    if rate_limit:
+        queue_handler.addFilter(RateLimitFilter(rate_limit))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, (_QueueHandler, FrameDumpHandler)):
+            root.removeHandler(handler)
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    root.addHandler(FrameDumpHandler())
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """停止后台写日志线程（写完队列中剩余的日志）"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,303 @@
+import struct
+import time
+
+import instrumentation
+import modbus_log
+
+
+# Modbus CRC-16 查表（多项式0x8005的反转0xA001，初值0xFFFF）
+def _build_crc_table():
+    table = []
+    for value in range(256):
+        crc = value
+        for _ in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC_TABLE = _build_crc_table()
+CRC_INIT = 0xFFFF
+
+
+def crc16(data, crc=CRC_INIT):
+    """计算/累加Modbus CRC-16（查表法）
+    :param data: 字节数据（bytes/bytearray/memoryview）
+    :param crc: 当前CRC值，可传入上一次的结果进行流式累加，默认0xFFFF
+    :return: 16位CRC整数值
+    """
+    table = CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def calculate_crc(data) -> bytes:
+    """计算Modbus CRC-16
+    :param data: 字节数组
+    :return: CRC校验码（2字节，低字节在前）
+    """
+    return struct.pack('<H', crc16(data))
+
+
+def append_crc(frame: bytearray) -> bytearray:
+    """在帧末尾追加CRC（低字节在前，高字节在后）
+    :param frame: 不含CRC的帧
+    :return: 原bytearray（已追加CRC）
+    """
+    crc = crc16(frame)
+    frame.append(crc & 0xFF)
+    frame.append(crc >> 8)
+    return frame
+
+
+def verify_crc(frame, length=None) -> bool:
+    """原地校验接收到的帧，不做切片拷贝
+    对包含CRC在内的整帧计算CRC，结果为0即校验通过
+    :param frame: 接收到的帧（含末尾2字节CRC）
+    :param length: 帧的有效长度，默认为整个缓冲区
+    :return: 校验是否通过
+    """
+    view = memoryview(frame)
+    if length is not None:
+        view = view[:length]
+    if len(view) < 4:
+        return False
+    return crc16(view) == 0
+
+
+# 固定长度应答的功能码（写单个/多个线圈、寄存器的回显应答均为8字节）
+FIXED_RESPONSE_LENGTHS = {
+    0x05: 8,
+    0x06: 8,
+    0x0F: 8,
+    0x10: 8,
+}
+# 带字节数字段的读应答：地址 + 功能码 + 字节数 + 数据 + CRC
+BYTE_COUNT_FUNCTIONS = (0x01, 0x02, 0x03, 0x04)
+
+
+def char_time(baudrate, bits_per_char=11):
+    """单个字符的传输时间（秒），RTU每字符按1起始位+8数据位+校验/停止位共11位计"""
+    return bits_per_char / baudrate
+
+
+def frame_gap(baudrate):
+    """t3.5帧间静默时间（秒），波特率高于19200时按协议规定固定为1.75ms"""
+    if baudrate > 19200:
+        return 0.00175
+    return 3.5 * char_time(baudrate)
+
+
+def expected_length(frame):
+    """根据已收到的帧头推算应答帧总长度
+    :param frame: 已接收的字节（至少需要地址、功能码、字节数/异常码共3字节）
+    :return: 帧总长度（含CRC），无法判断时返回None
+    """
+    if len(frame) < 3:
+        return None
+    function = frame[1]
+    if function & 0x80:
+        # 异常应答：地址 + 功能码|0x80 + 异常码 + CRC
+        return 5
+    if function in BYTE_COUNT_FUNCTIONS:
+        return 3 + frame[2] + 2
+    return FIXED_RESPONSE_LENGTHS.get(function)
+
+
+def _read_until_silence(ser):
+    """兜底接收：持续读取直到线路静默超过t3.5"""
+    gap = frame_gap(ser.baudrate)
+    data = bytearray()
+    while True:
+        time.sleep(gap)
+        waiting = ser.in_waiting
+        if not waiting:
+            return data
+        data += ser.read(waiting)
+
+
+def _read_frame(ser):
+    """接收一帧应答，同时返回收到帧头的时间（无应答时为None）"""
+    frame = bytearray(ser.read(3))
+    if len(frame) < 3:
+        return bytes(frame), None
+    header_time = time.monotonic()
+
+    length = expected_length(frame)
+    if length is not None:
+        frame += ser.read(length - len(frame))
+        if len(frame) == length and verify_crc(frame):
+            return bytes(frame), header_time
+
+    frame += _read_until_silence(ser)
+    return bytes(frame), header_time
+
+
+def read_frame(ser):
+    """按帧边界接收一帧RTU应答
+    先读帧头推算应答长度，完整帧到达且CRC通过即返回；
+    无法推算长度或CRC不通过时，退回到按t3.5静默判断帧结束。
+    整体等待时间受串口timeout限制。
+    :param ser: 串口对象
+    :return: 接收到的字节（超时时可能为空或不完整）
+    """
+    return _read_frame(ser)[0]
+
+
+def transact(ser, command):
+    """发送一帧RTU请求并按帧边界接收应答
+    :param ser: 串口对象，或总线调度器提供的串口替身（bus_scheduler.BusChannel）
+    :param command: 完整请求帧（含CRC）
+    :return: 应答字节
+    """
+    scheduled_transact = getattr(ser, 'scheduled_transact', None)
+    if scheduled_transact is not None:
+        # 由调度器排队执行，保证帧不交错并遵守优先级
+        return scheduled_transact(command)
+    if instrumentation.enabled:
+        return _instrumented_transact(ser, command)
+    port = getattr(ser, 'port', None)
+    modbus_log.record_frame(port, 'tx', command)
+    ser.write(command)
+    response = read_frame(ser)
+    modbus_log.record_frame(port, 'rx', response)
+    return response
+
+
+def transact_stop(ser, command):
+    """发送停止/安全指令
+    ser为总线调度器的串口替身时以最高优先级插队（与替身本身的优先级无关），否则与transact相同
+    :return: 应答字节
+    """
+    stop_transact = getattr(ser, 'stop_transact', None)
+    if stop_transact is not None:
+        return stop_transact(command)
+    return transact(ser, command)
+
+
+def _instrumented_transact(ser, command):
+    """transact的统计版本：按"串口/从机地址"和功能码记录延迟及结果"""
+    port = getattr(ser, 'port', None)
+    device = f"{port}/{command[0]}"
+    activity = instrumentation.bus_activity(port)
+    modbus_log.record_frame(port, 'tx', command)
+    start = time.monotonic()
+    activity.begin(start)
+    try:
+        ser.write(command)
+        response, header_time = _read_frame(ser)
+        modbus_log.record_frame(port, 'rx', response)
+    except Exception:
+        end = time.monotonic()
+        activity.end(end)
+        instrumentation.record_transaction(device, command[1], start, None, end,
+                                           instrumentation.RESULT_ERROR, len(command))
+        raise
+    end = time.monotonic()
+    activity.end(end)
+
+    exception_code = None
+    if len(response) < 5:
+        result = instrumentation.RESULT_TIMEOUT
+    elif not verify_crc(response):
+        result = instrumentation.RESULT_CRC
+    elif response[1] & 0x80:
+        result = instrumentation.RESULT_EXCEPTION
+        exception_code = response[2]
+    else:
+        result = instrumentation.RESULT_OK
+    instrumentation.record_transaction(device, command[1], start, header_time, end, result,
+                                       len(command), len(response), exception_code)
+    return response
+
+
+# 0x10写多个寄存器单帧最多123个寄存器
+MAX_WRITE_REGISTERS = 123
+# 0x03/0x04读寄存器单帧最多125个寄存器
+MAX_READ_REGISTERS = 125
+
+
+def build_read_command(address, function, register_address, count):
+    """生成读寄存器命令（0x03/0x04）
+    :param address: 从机地址
+    :param function: 功能码
+    :param register_address: 起始寄存器地址
+    :param count: 寄存器数量
+    :return: 完整命令（含CRC）
+    """
+    command = bytearray(struct.pack('>BBHH', address, function, register_address, count))
+    return append_crc(command)
+
+
+def build_write_registers_command(address, register_address, values):
+    """生成写多个寄存器命令（0x10）
+    :param address: 从机地址
+    :param register_address: 起始寄存器地址
+    :param values: 16位寄存器值列表
+    :return: 完整命令（含CRC）
+    """
+    count = len(values)
+    command = bytearray(struct.pack('>BBHHB', address, 0x10, register_address, count, count * 2))
+    command.extend(struct.pack(f'>{count}H', *values))
+    return append_crc(command)
+
+
+def check_write_response(response, address, function, register_address, value):
+    """校验写命令（0x06/0x10）的回显应答
+    :param response: 应答帧
+    :param address: 从机地址
+    :param function: 功能码
+    :param register_address: 起始寄存器地址
+    :param value: 0x06为写入值，0x10为寄存器数量
+    :return: 应答是否与请求一致
+    """
+    if len(response) != 8 or not verify_crc(response):
+        return False
+    return (response[0] == address and response[1] == function
+            and struct.unpack_from('>HH', response, 2) == (register_address, value))
+
+
+def parse_registers(response):
+    """解析读寄存器应答的数据区
+    :param response: 0x03/0x04应答帧
+    :return: 16位寄存器值元组，应答无效时返回None
+    """
+    if len(response) < 5 or response[1] & 0x80 or not verify_crc(response):
+        return None
+    byte_count = response[2]
+    if len(response) != byte_count + 5:
+        return None
+    return struct.unpack_from(f'>{byte_count // 2}H', response, 3)
+
+
+def group_registers(image, max_registers=MAX_WRITE_REGISTERS, keep_together=()):
+    """把{寄存器地址: 值}合并为尽量少的连续写入块
+    :param image: 待写入的寄存器映像
+    :param max_registers: 单帧最多寄存器数
+    :param keep_together: 双字参数低字地址集合，保证其与下一地址位于同一帧
+    :return: [(起始地址, [值, ...]), ...]
+    """
+    blocks = []
+    start = None
+    values = []
+    for register in sorted(image):
+        if start is not None and register == start + len(values) and len(values) < max_registers:
+            values.append(image[register])
+            continue
+        if start is not None and register == start + len(values) and (register - 1) in keep_together:
+            # 块已满但会拆开双字参数，把低字挪到下一块
+            values.pop()
+            if values:
+                blocks.append((start, values))
+            start, values = register - 1, [image[register - 1], image[register]]
+            continue
+        if start is not None:
+            blocks.append((start, values))
+        start, values = register, [image[register]]
+    if start is not None:
+        blocks.append((start, values))
+    return blocks
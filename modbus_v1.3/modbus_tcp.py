@@ -0,0 +1,423 @@
+import itertools
+import logging
+import socket
+import struct
+import threading
+import time
+from concurrent import futures
+
+import instrumentation
+import modbus_log
+
+
+logger = logging.getLogger(__name__)
+
+# MBAP报文头：事务标识符、协议标识符、长度、单元标识符
+MBAP_HEADER = struct.Struct('>HHHB')
+
+_transaction_ids = itertools.count(1)
+_transaction_lock = threading.Lock()
+
+
+def next_transaction_id():
+    """分配进程内递增的事务标识符（0x0001~0xFFFF循环）"""
+    with _transaction_lock:
+        return (next(_transaction_ids) - 1) % 0xFFFF + 1
+
+
+def build_adu(transaction_id, unit_id, pdu):
+    """组装Modbus TCP报文
+    :param transaction_id: 事务标识符
+    :param unit_id: 单元标识符
+    :param pdu: 功能码及数据
+    :return: 完整报文
+    """
+    return MBAP_HEADER.pack(transaction_id, 0x0000, len(pdu) + 1, unit_id) + bytes(pdu)
+
+
+class Transaction:
+    """一次在途请求"""
+
+    def __init__(self, transaction_id, unit_id, pdu):
+        self.transaction_id = transaction_id
+        self.unit_id = unit_id
+        self.pdu = bytes(pdu)
+        self.future = futures.Future()
+        self.queued_at = None
+        self.sent_at = None
+        self.latency = None  # 发送到收到应答的时间（秒）
+        self.activity = None  # 开启统计时所在总线的instrumentation.BusActivity
+
+    def end_activity(self, now):
+        """事务结束（应答、放弃或连接断开），从总线的在途事务中移除"""
+        activity, self.activity = self.activity, None
+        if activity is not None:
+            activity.end(now)
+
+    def result(self, timeout=None):
+        """等待应答
+        :return: 应答PDU（功能码及数据）
+        """
+        return self.future.result(timeout)
+
+
+class ModbusTcpTransport:
+    """支持流水线的Modbus TCP传输
+    每个请求分配递增的事务标识符，同一连接上最多window个请求同时在途，
+    后台线程按事务标识符匹配应答（允许乱序返回），并记录每个请求的延迟
+    """
+
+    def __init__(self, host, port=502, window=4, timeout=3.0):
+        """
+        :param host: 设备IP
+        :param port: 端口
+        :param window: 同时在途的最大请求数
+        :param timeout: 连接及等待应答的超时时间（秒）
+        """
+        self.host = host
+        self.port = port
+        self.window = window
+        self.timeout = timeout
+        self.sock = None
+        self._name = f"{host}:{port}"
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(window)
+        self._reader = None
+        self.closed = False  # 调用方主动关闭，连接池不自动重连
+
+    def connect(self):
+        """建立连接并启动接收线程
+        :return: 连接是否成功
+        """
+        if self.sock is not None:
+            return True
+        with self._connect_lock:
+            if self.sock is not None:
+                return True
+            self.closed = False
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            except OSError as e:
+                logger.warning("连接%s:%s失败: %s", self.host, self.port, e)
+                return False
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.sock = sock
+            self._reader = threading.Thread(target=self._read_loop, args=(sock,), daemon=True)
+            self._reader.start()
+        return True
+
+    def __repr__(self):
+        return f"ModbusTcpTransport({self.host}:{self.port})"
+
+    def is_open(self):
+        return self.sock is not None
+
+    def close(self):
+        """关闭连接，未完成的请求以ConnectionError结束"""
+        self.closed = True
+        self._disconnect()
+
+    def _disconnect(self):
+        """断开连接（意外断开，连接池会自动重连）"""
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self._fail_pending(ConnectionError("连接已关闭"))
+
+    def _fail_pending(self, error):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        now = time.monotonic()
+        for transaction in pending.values():
+            transaction.end_activity(now)
+            if transaction.future.set_running_or_notify_cancel():
+                transaction.future.set_exception(error)
+            self._slots.release()
+
+    def _recv_exact(self, sock, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("连接被对端关闭")
+            data += chunk
+        return data
+
+    def _read_loop(self, sock):
+        try:
+            while True:
+                header = self._recv_exact(sock, MBAP_HEADER.size)
+                header_time = time.monotonic()
+                transaction_id, _, length, unit_id = MBAP_HEADER.unpack(header)
+                pdu = bytes(self._recv_exact(sock, length - 1))
+                end = time.monotonic()
+                modbus_log.record_frame(self._name, 'rx', bytes(header) + pdu)
+                with self._lock:
+                    transaction = self._pending.pop(transaction_id, None)
+                if transaction is None:
+                    # 超时后才到达的应答或未知事务，丢弃
+                    continue
+                transaction.latency = end - transaction.sent_at
+                transaction.end_activity(end)
+                if instrumentation.enabled:
+                    self._record(transaction, header_time, end, pdu)
+                self._slots.release()
+                if transaction.future.set_running_or_notify_cancel():
+                    transaction.future.set_result(pdu)
+        except (OSError, ConnectionError) as e:
+            if self.sock is sock:
+                self.sock = None
+                sock.close()
+            self._fail_pending(ConnectionError(f"接收失败: {e}"))
+
+    def _device(self, unit_id):
+        return f"{self.host}:{self.port}/{unit_id}"
+
+    def _record(self, transaction, header_time, end, pdu):
+        """记录一次事务的统计"""
+        device = self._device(transaction.unit_id)
+        function = transaction.pdu[0]
+        instrumentation.record_queue(device, function, transaction.sent_at - transaction.queued_at)
+        exception_code = None
+        result = instrumentation.RESULT_OK
+        if pdu and pdu[0] & 0x80:
+            result = instrumentation.RESULT_EXCEPTION
+            exception_code = pdu[1] if len(pdu) > 1 else None
+        instrumentation.record_transaction(device, function, transaction.sent_at, header_time, end, result,
+                                           MBAP_HEADER.size + len(transaction.pdu),
+                                           MBAP_HEADER.size + len(pdu), exception_code)
+
+    def submit(self, unit_id, pdu):
+        """发送请求但不等待应答，在途请求达到window时阻塞
+        :param unit_id: 单元标识符
+        :param pdu: 功能码及数据
+        :return: Transaction
+        """
+        if not self.connect():
+            raise ConnectionError(f"无法连接{self.host}:{self.port}")
+        queued_at = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("在途请求过多，等待发送窗口超时")
+
+        transaction = Transaction(next_transaction_id(), unit_id, pdu)
+        transaction.queued_at = queued_at
+        adu = build_adu(transaction.transaction_id, unit_id, transaction.pdu)
+        with self._lock:
+            self._pending[transaction.transaction_id] = transaction
+        try:
+            with self._send_lock:
+                # 在发送前记录，保证抓包中请求排在其应答之前
+                modbus_log.record_frame(self._name, 'tx', adu)
+                transaction.sent_at = time.monotonic()
+                if instrumentation.enabled:
+                    transaction.activity = instrumentation.bus_activity(self._name)
+                    transaction.activity.begin(transaction.sent_at)
+                self.sock.sendall(adu)
+        except (OSError, AttributeError) as e:
+            with self._lock:
+                removed = self._pending.pop(transaction.transaction_id, None) is not None
+            # 接收线程断开连接时可能已由_fail_pending取走该事务并释放窗口
+            if removed:
+                transaction.end_activity(time.monotonic())
+                self._slots.release()
+            self._disconnect()
+            raise ConnectionError(f"发送失败: {e}")
+        return transaction
+
+    def discard(self, transaction):
+        """放弃等待某个请求（如超时），释放其占用的窗口"""
+        with self._lock:
+            if self._pending.pop(transaction.transaction_id, None) is None:
+                return
+        transaction.end_activity(time.monotonic())
+        self._slots.release()
+        if instrumentation.enabled:
+            instrumentation.record_transaction(self._device(transaction.unit_id), transaction.pdu[0],
+                                               transaction.sent_at, None, time.monotonic(),
+                                               instrumentation.RESULT_TIMEOUT,
+                                               MBAP_HEADER.size + len(transaction.pdu))
+
+    def request(self, unit_id, pdu, timeout=None):
+        """发送请求并等待应答
+        :return: 应答PDU（功能码及数据）
+        """
+        transaction = self.submit(unit_id, pdu)
+        try:
+            return transaction.result(self.timeout if timeout is None else timeout)
+        except futures.TimeoutError:
+            self.discard(transaction)
+            raise
+
+    def pending_count(self):
+        """当前在途请求数"""
+        return len(self._pending)
+
+    def request_many(self, requests):
+        """流水线发送多个请求并按顺序返回应答
+        :param requests: [(单元标识符, PDU), ...]
+        :return: [(应答PDU, 延迟秒数), ...]
+        """
+        transactions = [self.submit(unit_id, pdu) for unit_id, pdu in requests]
+        results = []
+        for transaction in transactions:
+            try:
+                pdu = transaction.result(self.timeout)
+            except futures.TimeoutError:
+                self.discard(transaction)
+                raise
+            results.append((pdu, transaction.latency))
+        return results
+
+
+class ConnectionPool:
+    """进程内共享的Modbus TCP连接池
+    按(主机, 端口)复用连接，访问同一网关的各驱动共用同一组连接；
+    每个主机的连接数不超过max_per_host（很多小型网关只允许1~4个连接），
+    后台线程定期检查连接，意外断开的连接自动重连（调用close()主动关闭的连接除外）
+    """
+
+    def __init__(self, max_per_host=1, window=4, timeout=3.0, check_interval=5.0):
+        """
+        :param max_per_host: 每个(主机, 端口)的最大连接数
+        :param window: 每个连接同时在途的最大请求数
+        :param timeout: 连接及等待应答的超时时间（秒）
+        :param check_interval: 后台检查/重连间隔（秒）
+        """
+        self.max_per_host = max_per_host
+        self.window = window
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._monitor = None
+
+    def get(self, host, port=502):
+        """获取到指定主机的连接
+        已有连接都在忙且未达上限时新建连接，否则返回在途请求最少的连接
+        :return: ModbusTcpTransport（可能尚未连接，首次请求时自动连接）
+        """
+        key = (host, port)
+        with self._lock:
+            transports = self._hosts.setdefault(key, [])
+            # 调用方主动关闭的连接不再分配
+            transports[:] = [t for t in transports if not t.closed]
+            idle = [t for t in transports if t.pending_count() == 0]
+            if idle:
+                transport = idle[0]
+            elif len(transports) < self.max_per_host:
+                transport = ModbusTcpTransport(host, port, self.window, self.timeout)
+                transports.append(transport)
+            else:
+                transport = min(transports, key=ModbusTcpTransport.pending_count)
+            self._start_monitor()
+        return transport
+
+    def _start_monitor(self):
+        if self._monitor is None or not self._monitor.is_alive():
+            self._stop.clear()
+            self._monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+            self._monitor.start()
+
+    def _monitor_loop(self):
+        while not self._stop.wait(self.check_interval):
+            with self._lock:
+                transports = [t for group in self._hosts.values() for t in group]
+            for transport in transports:
+                if not transport.is_open() and not transport.closed:
+                    # 意外断开的连接后台重连，失败则等下一次检查；主动关闭的不重连
+                    transport.connect()
+
+    def close_all(self):
+        """关闭并移除全部连接，停止后台线程"""
+        self._stop.set()
+        with self._lock:
+            hosts, self._hosts = self._hosts, {}
+        for transports in hosts.values():
+            for transport in transports:
+                transport.close()
+
+
+# 进程内默认连接池
+default_pool = ConnectionPool()
+
+
+def get_transport(host, port=502):
+    """从默认连接池获取连接"""
+    return default_pool.get(host, port)
+
+
+def check_response(pdu, function_code):
+    """检查应答PDU的功能码，异常应答时抛出异常
+    :param pdu: 应答PDU
+    :param function_code: 请求的功能码
+    """
+    if not pdu:
+        raise ValueError("应答为空")
+    if pdu[0] == function_code | 0x80:
+        raise ValueError(f"设备返回异常码: {pdu[1] if len(pdu) > 1 else None}")
+    if pdu[0] != function_code:
+        raise ValueError(f"应答功能码不匹配: {pdu[0]:#04x}")
+
+
+def pack_coils(states):
+    """把线圈状态列表打包为0x0F的数据字节（低位在前）
+    :param states: 线圈状态序列（真为开）
+    :return: 数据字节
+    """
+    data = bytearray((len(states) + 7) // 8)
+    for index, state in enumerate(states):
+        if state:
+            data[index >> 3] |= 1 << (index & 7)
+    return bytes(data)
+
+
+def unpack_coils(data, count):
+    """把0x01应答的数据字节解包为线圈状态列表"""
+    return [bool(data[index >> 3] >> (index & 7) & 1) for index in range(count)]
+
+
+def read_coils_pdu(address, count):
+    """生成读线圈（0x01）PDU"""
+    return struct.pack('>BHH', 0x01, address, count)
+
+
+def write_coils_pdu(address, states):
+    """生成写多个线圈（0x0F）PDU"""
+    data = pack_coils(states)
+    return struct.pack('>BHHB', 0x0F, address, len(states), len(data)) + data
+
+
+def check_write_coils_response(pdu, address, count):
+    """校验0x0F应答回显的起始地址和线圈数量"""
+    check_response(pdu, 0x0F)
+    if len(pdu) != 5 or struct.unpack_from('>HH', pdu, 1) != (address, count):
+        raise ValueError(f"写线圈应答不匹配: {pdu.hex()}")
+
+
+def changed_ranges(old, new, bridge=True):
+    """找出新旧线圈映像不同的连续区间
+    :param old: 当前状态列表（None表示未知，总是需要写入）
+    :param new: 目标状态列表（None表示不关心，不写入）
+    :param bridge: 为True时，两个区间之间的目标状态均已知则合并为一个区间，一帧写入
+    :return: [(起始下标, 结束下标(不含)), ...]
+    """
+    ranges = []
+    for index, (current, target) in enumerate(zip(old, new)):
+        if target is None or (current is not None and bool(current) == bool(target)):
+            continue
+        if ranges and (ranges[-1][1] == index
+                       or bridge and all(state is not None for state in new[ranges[-1][1]:index])):
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return [tuple(r) for r in ranges]
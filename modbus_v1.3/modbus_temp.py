@@ -2,53 +2,154 @@ import socket
 import struct
 import logging
 
-# 启用调试日志
-logging.basicConfig(level=logging.DEBUG)
-
-# 设置目标设备的 IP 和端口
-host = '192.168.3.7'  # 目标设备 IP
-port = 502  # Modbus TCP 端口
-
-# 构造 Modbus 请求数据包
-# 事务标识符: 00 00 (2 字节)
-# 协议标识符: 00 00 (2 字节)
-# 长度: 00 06 (2 字节)
-# 设备地址: 01 (1 字节)
-# 功能码: 04 (1 字节)
-# 起始地址: 01 90 (2 字节)
-# 通道个数: 00 01 (2 字节)
-request = struct.pack('>HHHBBHH', 0x0000, 0x0000, 0x0006, 0x01, 0x04, 0x0190, 0x0001)
-
-# 发送请求并接收响应
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-    sock.connect((host, port))  # 连接到目标设备
-    sock.send(request)  # 发送 Modbus 请求
-    response = sock.recv(1024)  # 接收响应数据
-
-# 打印响应数据
-print("收到响应:", response.hex())
-
-# 解析响应数据
-if response:
-    # 跳过事务标识符、协议标识符和长度部分，直接获取数据部分
-    data = response[9:]  # 从索引 9 开始获取数据部分（跳过前 9 字节）
-
-    # 打印原始数据
-    print(f"原始数据 (数据部分): {data.hex()}")
-
-    # 检查数据长度（通常是 2 字节寄存器）
-    if len(data) >= 2:
-        try:
-            # 提取前 2 字节作为寄存器值
-            register_value = struct.unpack('>H', data[:2])[0]  # >H 表示大端格式 2 字节无符号整数
-            print(f"寄存器值 (原始数据): {register_value}")
-
-            # 将寄存器值转换为温度（假设每个单位表示 0.1°C）
-            temperature = register_value / 10  # 转换为温度（例如 274 -> 27.4°C）
-            print(f"读取到的温度: {temperature}°C")
-        except struct.error as e:
-            print(f"字节解析错误: {e}")
+import numpy as np
+
+import instrumentation
+import modbus_log
+import modbus_tcp
+
+logger = logging.getLogger(__name__)
+
+# 温度通道寄存器起始地址（输入寄存器，每通道1个寄存器，单位0.1°C）
+TEMP_REGISTER = 0x0190
+# 断线/未接传感器时模块返回的哨兵值
+OPEN_SENSOR_VALUES = (0x7FFF, -0x8000)
+
+
+class TemperatureModule:
+    """一个温度采集模块的通道配置及解码"""
+
+    def __init__(self, transport, unit_id=0x01, channels=8, start=TEMP_REGISTER,
+                 scale=0.1, offset=0.0, open_values=OPEN_SENSOR_VALUES, name=None):
+        """
+        :param transport: modbus_tcp.ModbusTcpTransport
+        :param unit_id: 单元标识符
+        :param channels: 通道数
+        :param start: 第一个通道的输入寄存器地址
+        :param scale: 换算系数，可为标量或每通道一个值
+        :param offset: 零点偏移（°C），可为标量或每通道一个值
+        :param open_values: 表示断线的原始值（有符号）
+        :param name: 模块名称，默认为"IP/单元标识符"
+        """
+        self.transport = transport
+        self.unit_id = unit_id
+        self.channels = channels
+        self.start = start
+        self.scale = np.broadcast_to(np.asarray(scale, dtype=np.float64), (channels,))
+        self.offset = np.broadcast_to(np.asarray(offset, dtype=np.float64), (channels,))
+        self.open_values = np.asarray(open_values, dtype=np.int16)
+        self.name = name or f"{transport.host}/{unit_id}"
+        self.request_pdu = struct.pack('>BHH', 0x04, start, channels)
+
+    def decode(self, pdu):
+        """一次向量化解码0x04应答中的全部通道
+        :param pdu: 应答PDU（功能码、字节数、数据）
+        :return: 温度数组（°C），断线通道被屏蔽
+        """
+        modbus_tcp.check_response(pdu, 0x04)
+        if pdu[1] != self.channels * 2 or len(pdu) < 2 + self.channels * 2:
+            raise ValueError(f"{self.name} 应答字节数不符: {pdu[1]}")
+        raw = np.frombuffer(pdu, dtype='>i2', count=self.channels, offset=2)
+        values = raw * self.scale + self.offset
+        return np.ma.masked_array(values, mask=np.isin(raw, self.open_values))
+
+
+class TemperatureScanner:
+    """多模块温度扫描
+    每个模块用一帧0x04读取全部通道；一个扫描周期内先把所有模块的请求发出
+    （同一连接上流水线发送），再统一收集应答并解码
+    """
+
+    def __init__(self, modules):
+        """
+        :param modules: TemperatureModule列表
+        """
+        self.modules = list(modules)
+
+    def scan(self):
+        """扫描全部模块
+        :return: {模块名称: 温度数组}，读取失败的模块值为None
+        """
+        transactions = []
+        for module in self.modules:
+            try:
+                transactions.append(module.transport.submit(module.unit_id, module.request_pdu))
+            except (ConnectionError, TimeoutError) as e:
+                logger.error("%s 发送失败: %s", module.name, e)
+                transactions.append(None)
+
+        results = {}
+        for module, transaction in zip(self.modules, transactions):
+            if transaction is None:
+                results[module.name] = None
+                continue
+            try:
+                pdu = transaction.result(module.transport.timeout)
+                results[module.name] = module.decode(pdu)
+                if instrumentation.enabled:
+                    for channel, value in enumerate(results[module.name].filled(float('nan'))):
+                        instrumentation.set_value('temperature_celsius', float(value),
+                                                  module=module.name, channel=channel + 1)
+            except Exception as e:
+                module.transport.discard(transaction)
+                logger.error("%s 读取失败: %s", module.name, e)
+                results[module.name] = None
+        return results
+
+
+def main(host='192.168.3.7', port=502):
+    """读取一个温度通道并打印（导入本模块时不做任何通信）
+    :param host: 目标设备 IP
+    :param port: Modbus TCP 端口
+    """
+    # 启用调试日志
+    modbus_log.setup_logging(level=logging.DEBUG)
+
+    # 构造 Modbus 请求数据包
+    # 事务标识符: 递增分配 (2 字节)
+    # 协议标识符: 00 00 (2 字节)
+    # 长度: 00 06 (2 字节)
+    # 设备地址: 01 (1 字节)
+    # 功能码: 04 (1 字节)
+    # 起始地址: 01 90 (2 字节)
+    # 通道个数: 00 01 (2 字节)
+    request = struct.pack('>HHHBBHH', modbus_tcp.next_transaction_id(), 0x0000, 0x0006, 0x01, 0x04, 0x0190, 0x0001)
+
+    # 发送请求并接收响应
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.connect((host, port))  # 连接到目标设备
+        sock.send(request)  # 发送 Modbus 请求
+        response = sock.recv(1024)  # 接收响应数据
+
+    # 打印响应数据
+    print("收到响应:", response.hex())
+
+    # 解析响应数据
+    if response:
+        # 跳过事务标识符、协议标识符和长度部分，直接获取数据部分
+        data = response[9:]  # 从索引 9 开始获取数据部分（跳过前 9 字节）
+
+        # 打印原始数据
+        print(f"原始数据 (数据部分): {data.hex()}")
+
+        # 检查数据长度（通常是 2 字节寄存器）
+        if len(data) >= 2:
+            try:
+                # 提取前 2 字节作为寄存器值
+                register_value = struct.unpack('>H', data[:2])[0]  # >H 表示大端格式 2 字节无符号整数
+                print(f"寄存器值 (原始数据): {register_value}")
+
+                # 将寄存器值转换为温度（假设每个单位表示 0.1°C）
+                temperature = register_value / 10  # 转换为温度（例如 274 -> 27.4°C）
+                print(f"读取到的温度: {temperature}°C")
+            except struct.error as e:
+                print(f"字节解析错误: {e}")
+        else:
+            print("响应数据不足，无法提取温度数据")
     else:
-        print("响应数据不足，无法提取温度数据")
-else:
-    print("没有收到有效响应")
+        print("没有收到有效响应")
+    modbus_log.stop_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,11 @@
 import struct
-from pymodbus.client import ModbusTcpClient
 import logging
 
-# 启用调试日志
-logging.basicConfig(level=logging.DEBUG)
+import modbus_log
+import modbus_tcp
 
-# 设置 Modbus TCP 客户端
-client = ModbusTcpClient('192.168.3.30', port=502)
+logger = logging.getLogger(__name__)
 
-# 连接到 Modbus 服务器
-if client.connect():
-    print("连接成功")
-else:
-    print("连接失败")
-    client.close()
-    exit()
 
 def send_valve_command(client, unit_id=0x01, address=0x00, data=0x0101):
     """
@@ -27,15 +18,16 @@ def send_valve_command(client, unit_id=0x01, address=0x00, data=0x0101):
     """
     try:
         # 构建 Modbus TCP 数据包
-        tcp_header = struct.pack('>HHH', 0x0000, 0x0000, 0x08)  # 事务标识符、协议标识符、数据长度
+        tcp_header = struct.pack('>HHH', modbus_tcp.next_transaction_id(), 0x0000, 0x08)  # 事务标识符、协议标识符、数据长度
         
-        # 功能码0x0F（写多个线圈），地址为传入的address，数据为传入的data
-        modbus_data = struct.pack('>B B H H H', 
+        # 功能码0x0F（写多个线圈），地址为传入的address，data非0为开启
+        modbus_data = struct.pack('>B B H H B B', 
             unit_id,     # 单元ID 
             0x0F,        # 功能码（写多个线圈）
             address,     # 起始地址
             0x0001,      # 线圈数量（固定为1）
-            data         # 控制数据
+            0x01,        # 字节数
+            0x01 if data else 0x00  # 线圈状态
         )
         
         # 合并 TCP 头部和 Modbus 数据部分
@@ -46,18 +38,119 @@ def send_valve_command(client, unit_id=0x01, address=0x00, data=0x0101):
         
         # 打印响应（如果有的话）
         if response:
-            print(f"发送阀门控制指令成功，地址：{address}，数据：{hex(data)}")
-            print("收到响应:", response)
+            logger.info("发送阀门控制指令成功，地址：%s，数据：%#x", address, data)
+            logger.debug("收到响应: %s", response)
             return True
         else:
-            print(f"发送阀门控制指令失败，地址：{address}，数据：{hex(data)}")
+            logger.error("发送阀门控制指令失败，地址：%s，数据：%#x", address, data)
             return False
     except Exception as e:
-        print(f"发送阀门控制指令时发生错误: {e}")
+        logger.error("发送阀门控制指令时发生错误: %s", e)
         return False
 
-# 发送阀门控制指令
-send_valve_command(client, address=0x00, data=0x0101)
+class ValveIsland:
+    """阀岛整组控制
+    按位掩码一次写入全部阀门（一帧0x0F），校验应答回显的地址和数量，
+    并缓存上次写入的状态，状态未变化时不发送
+    """
+
+    def __init__(self, transport, unit_id=0x01, valve_count=8, base_address=0x0000):
+        """
+        :param transport: modbus_tcp.ModbusTcpTransport
+        :param unit_id: 单元标识符
+        :param valve_count: 阀门数量
+        :param base_address: 第一个阀门的线圈地址
+        """
+        self.transport = transport
+        self.unit_id = unit_id
+        self.valve_count = valve_count
+        self.base_address = base_address
+        self.state = None  # 上次成功写入的位掩码，None表示未知
+
+    def set_mask(self, mask, force=False):
+        """按位掩码设置全部阀门，第0位对应第1个阀门
+        :param mask: 位掩码，1为开启
+        :param force: 为True时即使状态未变化也发送
+        :return: 是否发送了指令
+        """
+        if mask < 0 or mask >> self.valve_count:
+            raise ValueError(f"掩码超出{self.valve_count}个阀门的范围: {mask:#x}")
+        if not force and mask == self.state:
+            return False
+
+        states = [mask >> index & 1 for index in range(self.valve_count)]
+        try:
+            pdu = self.transport.request(self.unit_id, modbus_tcp.write_coils_pdu(self.base_address, states))
+            modbus_tcp.check_write_coils_response(pdu, self.base_address, self.valve_count)
+        except Exception:
+            # 超时、断线或应答不符时阀门可能已经动作，状态置为未知，下次先读回
+            self.state = None
+            raise
+        self.state = mask
+        return True
+
+    def refresh(self):
+        """用一帧0x01读回全部阀门的线圈状态，更新缓存
+        :return: 位掩码
+        """
+        pdu = self.transport.request(self.unit_id, modbus_tcp.read_coils_pdu(self.base_address, self.valve_count))
+        modbus_tcp.check_response(pdu, 0x01)
+        states = modbus_tcp.unpack_coils(pdu[2:], self.valve_count)
+        self.state = sum(1 << index for index, state in enumerate(states) if state)
+        return self.state
+
+    def _current_mask(self):
+        """当前状态；未知时（刚启动或上次写入失败）先读回，不能假定阀门全部关闭"""
+        if self.state is None:
+            return self.refresh()
+        return self.state
+
+    def open(self, *valves):
+        """开启指定阀门（序号从0起），其余阀门保持不变"""
+        mask = self._current_mask()
+        for valve in valves:
+            mask |= 1 << valve
+        return self.set_mask(mask)
+
+    def close(self, *valves):
+        """关闭指定阀门（序号从0起），其余阀门保持不变"""
+        mask = self._current_mask()
+        for valve in valves:
+            mask &= ~(1 << valve)
+        return self.set_mask(mask)
+
+    def close_all(self):
+        """关闭全部阀门"""
+        return self.set_mask(0)
+
+
+def main(host='192.168.3.30', port=502):
+    """连接设备并发送阀门控制指令（导入本模块时不做任何通信）"""
+    # pymodbus只在直接运行本脚本时需要
+    from pymodbus.client import ModbusTcpClient
+
+    # 启用调试日志
+    modbus_log.setup_logging(level=logging.DEBUG)
+
+    # 设置 Modbus TCP 客户端
+    client = ModbusTcpClient(host, port=port)
+
+    # 连接到 Modbus 服务器
+    if client.connect():
+        logger.info("连接成功")
+    else:
+        logger.error("连接失败")
+        client.close()
+        modbus_log.stop_logging()
+        return
+
+    # 发送阀门控制指令
+    send_valve_command(client, address=0x00, data=0x0101)
+
+    # 关闭连接
+    client.close()
+    modbus_log.stop_logging()
+
 
-# 关闭连接
-client.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+import modbus_rtu
+import modbus_tcp
+
+
+class RegisterCache:
+    """驱动下层的读穿透寄存器缓存
+    - 每个寄存器区间可设置各自的有效期（TTL）
+    - 同一区间的并发读取合并为一次在途事务，其他调用者等待同一结果
+    - 相邻（间隔不超过merge_gap）且已过期的已知区间合并为一次更宽的读取
+    - 写入后使对应区间失效，与写入并发的在途读取结果不写入缓存，等待它的调用者重新读取
+    """
+
+    def __init__(self, reader, default_ttl=0.1, merge_gap=4, max_registers=modbus_rtu.MAX_READ_REGISTERS):
+        """
+        :param reader: 读函数reader(slave, function, start, count)，返回寄存器值序列，失败时返回None或抛出异常
+        :param default_ttl: 未单独设置时的有效期（秒）
+        :param merge_gap: 合并读取时允许跨过的最大空隙寄存器数
+        :param max_registers: 单次读取最多寄存器数
+        """
+        self.reader = reader
+        self.default_ttl = default_ttl
+        self.merge_gap = merge_gap
+        self.max_registers = max_registers
+        self._ttls = []       # [(slave, function, start, end, ttl), ...]
+        self._values = {}     # (slave, function, register) -> (value, 读取时间)
+        self._inflight = {}   # (slave, function, start, count) -> Future
+        self._known = set()   # 曾经读取过的区间 (slave, function, start, count)
+        # 失效代数：每次invalidate加1，并记录各寄存器最后一次失效时的代数；
+        # 读取期间寄存器被失效（读与写并发）时，读到的可能是写入前的值，不写入缓存
+        self._generation = 0
+        self._invalidated = {}  # (slave, register) -> 代数
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def set_ttl(self, start, count, ttl, slave=None, function=None):
+        """设置寄存器区间的有效期
+        :param slave: 从机地址，None表示所有从机
+        :param function: 功能码，None表示所有读功能码
+        """
+        with self._lock:
+            self._ttls.insert(0, (slave, function, start, start + count, ttl))
+
+    def ttl_for(self, slave, function, register):
+        for ttl_slave, ttl_function, start, end, ttl in self._ttls:
+            if (ttl_slave is None or ttl_slave == slave) and (ttl_function is None or ttl_function == function) \
+                    and start <= register < end:
+                return ttl
+        return self.default_ttl
+
+    def _fresh(self, slave, function, register, now):
+        entry = self._values.get((slave, function, register))
+        return entry is not None and now - entry[1] < self.ttl_for(slave, function, register)
+
+    def _cached(self, slave, function, start, count, now):
+        values = []
+        for register in range(start, start + count):
+            if not self._fresh(slave, function, register, now):
+                return None
+            values.append(self._values[(slave, function, register)][0])
+        return tuple(values)
+
+    def _plan(self, slave, function, start, count, now):
+        """扩大读取范围，把相邻且已过期的已知区间一并读出"""
+        end = start + count
+        changed = True
+        while changed:
+            changed = False
+            for known_slave, known_function, known_start, known_count in self._known:
+                known_end = known_start + known_count
+                if known_slave != slave or known_function != function:
+                    continue
+                if known_start >= start and known_end <= end:
+                    continue
+                if known_start - end > self.merge_gap or start - known_end > self.merge_gap:
+                    continue
+                new_start, new_end = min(start, known_start), max(end, known_end)
+                if new_end - new_start > self.max_registers:
+                    continue
+                if all(self._fresh(slave, function, r, now) for r in range(known_start, known_end)):
+                    continue
+                start, end, changed = new_start, new_end, True
+        return start, end - start
+
+    def read(self, slave, start, count, function=0x03):
+        """读取寄存器，缓存有效时不访问总线
+        :return: 寄存器值元组，读取失败时返回None
+        """
+        with self._lock:
+            now = time.monotonic()
+            values = self._cached(slave, function, start, count, now)
+            if values is not None:
+                self.hits += 1
+                return values
+
+            # 已有覆盖该区间的在途读取时直接等待其结果
+            for (flight_slave, flight_function, flight_start, flight_count), future in self._inflight.items():
+                if flight_slave == slave and flight_function == function \
+                        and flight_start <= start and start + count <= flight_start + flight_count:
+                    self.coalesced += 1
+                    break
+            else:
+                future = None
+                self.misses += 1
+                self._known.add((slave, function, start, count))
+                fetch_start, fetch_count = self._plan(slave, function, start, count, now)
+                key = (slave, function, fetch_start, fetch_count)
+                leader = Future()
+                self._inflight[key] = leader
+                generation = self._generation
+
+        if future is not None:
+            result = future.result()
+            if result is None:
+                return None
+            flight_start, values, stale = result
+            if stale:
+                # 等待期间区间被写入，重新读取
+                return self.read(slave, start, count, function)
+            return tuple(values[start - flight_start:start - flight_start + count])
+
+        # 本调用者负责实际读取
+        try:
+            values = self.reader(slave, function, fetch_start, fetch_count)
+        except Exception:
+            values = None
+        result = None
+        with self._lock:
+            if self._inflight.get(key) is leader:
+                del self._inflight[key]
+            if values is not None and len(values) == fetch_count:
+                registers = range(fetch_start, fetch_start + fetch_count)
+                stale = self._generation != generation and any(
+                    self._invalidated.get((slave, register), 0) > generation for register in registers)
+                if not stale:
+                    read_time = time.monotonic()
+                    for register, value in zip(registers, values):
+                        self._values[(slave, function, register)] = (value, read_time)
+                result = (fetch_start, tuple(values), stale)
+        leader.set_result(result)
+        if result is None:
+            return None
+        return result[1][start - fetch_start:start - fetch_start + count]
+
+    def invalidate(self, slave, start, count, function=None):
+        """使寄存器区间失效（写入后调用）
+        :param function: 功能码，None表示所有读功能码
+        """
+        with self._lock:
+            for key in [k for k in self._values
+                        if k[0] == slave and (function is None or k[1] == function)
+                        and start <= k[2] < start + count]:
+                del self._values[key]
+            # 正在进行的读取可能读到写入前的值：标记失效代数，并且不再让新的调用者等待这些读取
+            self._generation += 1
+            for register in range(start, start + count):
+                self._invalidated[(slave, register)] = self._generation
+            for key in [k for k in self._inflight
+                        if k[0] == slave and (function is None or k[1] == function)
+                        and k[2] < start + count and start < k[2] + k[3]]:
+                del self._inflight[key]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+def rtu_reader(ser):
+    """生成基于RTU串口（或总线调度器通道）的读函数"""
+    def read(slave, function, start, count):
+        command = modbus_rtu.build_read_command(slave, function, start, count)
+        return modbus_rtu.parse_registers(modbus_rtu.transact(ser, command))
+    return read
+
+
+def tcp_reader(transport):
+    """生成基于modbus_tcp.ModbusTcpTransport的读函数"""
+    def read(slave, function, start, count):
+        pdu = transport.request(slave, struct.pack('>BHH', function, start, count))
+        modbus_tcp.check_response(pdu, function)
+        return struct.unpack_from(f'>{pdu[1] // 2}H', pdu, 2)
+    return read